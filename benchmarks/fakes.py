@@ -0,0 +1,228 @@
+"""Offline stand-ins for yt-dlp, the Anthropic client and discord's VoiceClient.
+
+Each fake sleeps for a configurable latency instead of touching the network, so runs
+measure the bot's own overhead plus whatever latency profile is configured.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import itertools
+import struct
+import sys
+import threading
+import time
+import types
+from dataclasses import dataclass
+from pathlib import Path
+
+
+@dataclass
+class Latency:
+    """Simulated latencies, in seconds."""
+    extract: float = 0.0  # yt-dlp metadata extraction / search
+    download: float = 0.0  # yt-dlp download and conversion
+    recommend: float = 0.0  # one Claude recommendation call
+    track: float = 0.05  # how long a fake voice client "plays" each track
+
+
+LATENCY = Latency()
+
+
+# --- Ogg Opus -----------------------------------------------------------------
+
+def _ogg_crc(data: bytes) -> int:
+    crc = 0
+    for byte in data:
+        crc ^= byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else crc << 1
+            crc &= 0xFFFFFFFF
+    return crc
+
+
+def _ogg_page(packet: bytes, sequence: int, granule: int, header_type: int) -> bytes:
+    segments = [255] * (len(packet) // 255) + [len(packet) % 255]
+    header = struct.pack(
+        "<4sBBqIII", b"OggS", 0, header_type, granule, 0x4D555349, sequence, 0
+    ) + bytes([len(segments)]) + bytes(segments)
+    page = header + packet
+    crc = _ogg_crc(page)
+    return page[:22] + struct.pack("<I", crc) + page[26:]
+
+
+# 20 ms CELT fullband stereo frame (TOC config 31, code 0) holding digital silence
+_SILENT_PACKET = b"\xfc\xff\xfe"
+
+
+def ogg_opus_bytes(packets: int = 50) -> bytes:
+    """A valid 48 kHz / 20 ms Ogg Opus stream that the passthrough player accepts."""
+    head = b"OpusHead" + struct.pack("<BBHIhB", 1, 2, 312, 48000, 0, 0)
+    tags = b"OpusTags" + struct.pack("<I", 5) + b"bench" + struct.pack("<I", 0)
+    pages = [_ogg_page(head, 0, 0, 0x02), _ogg_page(tags, 1, 0, 0)]
+    for i in range(packets):
+        header_type = 0x04 if i == packets - 1 else 0
+        pages.append(_ogg_page(_SILENT_PACKET, i + 2, 960 * (i + 1), header_type))
+    return b"".join(pages)
+
+
+_OGG_TEMPLATE = ogg_opus_bytes()
+
+
+def write_audio(path: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(_OGG_TEMPLATE)
+
+
+# --- yt-dlp -------------------------------------------------------------------
+
+def _video_id(text: str) -> str:
+    return hashlib.sha1(text.encode()).hexdigest()[:11]
+
+
+class FakeYoutubeDL:
+    def __init__(self, params: dict | None = None):
+        self.params = params or {}
+
+    def _info(self, query: str) -> dict:
+        if "watch?v=" in query:
+            video_id = query.split("watch?v=", 1)[1][:11]
+        else:
+            video_id = _video_id(query.removeprefix("ytsearch1:"))
+        return {
+            "id": video_id,
+            "title": f"Song {video_id}",
+            "uploader": "Bench Artist",
+            "webpage_url": f"https://www.youtube.com/watch?v={video_id}",
+            "url": f"https://media.invalid/{video_id}",
+            "duration": 180,
+            "ext": "webm",
+        }
+
+    def extract_info(self, url: str, download: bool = True, process: bool = True, ie_key: str | None = None):
+        time.sleep(LATENCY.extract)
+        info = self._info(url)
+        if url.startswith("ytsearch"):
+            return {"_type": "playlist", "entries": [info]}
+        if download:
+            return self.process_ie_result(info, download=True)
+        return info
+
+    def process_ie_result(self, info: dict, download: bool = True) -> dict:
+        time.sleep(LATENCY.download)
+        template = self.params.get("outtmpl", "%(id)s.%(ext)s")
+        if isinstance(template, dict):
+            template = template["default"]
+        path = Path(template % {"id": info["id"], "ext": "opus"})
+        write_audio(path)
+        return {**info, "requested_downloads": [{"filepath": str(path)}]}
+
+
+# --- Anthropic ----------------------------------------------------------------
+
+_song_ids = itertools.count()
+
+
+class _Messages:
+    async def create(self, **kwargs):
+        await asyncio.sleep(LATENCY.recommend)
+        lines = "\n".join(f"Chillax Artist {n} - Chillax Song {n}" for n in itertools.islice(_song_ids, 10))
+        return types.SimpleNamespace(content=[types.SimpleNamespace(text=lines)])
+
+
+class FakeAsyncAnthropic:
+    def __init__(self, *args, **kwargs):
+        self.messages = _Messages()
+
+
+# --- discord voice -------------------------------------------------------------
+
+class FakeVoiceClient:
+    """Plays each source on its own thread for ``LATENCY.track`` seconds, like discord's
+    voice thread, and records the gap between one track ending and the next starting."""
+
+    def __init__(self, channel=None, listeners: int = 1):
+        if channel is None:
+            member = types.SimpleNamespace(bot=False)
+            channel = types.SimpleNamespace(id=0, members=[member] * listeners, name="bench")
+        self.channel = channel
+        self.plays = 0
+        self.gaps: list[float] = []
+        self._ended_at: float | None = None
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._connected = True
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def is_playing(self) -> bool:
+        return self._thread is not None and self._thread.is_alive() and not self._stop.is_set()
+
+    def is_paused(self) -> bool:
+        return False
+
+    def play(self, source, *, after=None):
+        now = time.perf_counter()
+        if self._ended_at is not None:
+            self.gaps.append(now - self._ended_at)
+            self._ended_at = None
+        self.plays += 1
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(source, after, self._stop), daemon=True)
+        self._thread.start()
+
+    def _run(self, source, after, stop: threading.Event):
+        source.read()
+        stopped = stop.wait(LATENCY.track)
+        stop.set()  # like discord, no longer "playing" by the time the after callback runs
+        source.cleanup()
+        if not stopped:
+            self._ended_at = time.perf_counter()
+        if after:
+            after(None)
+
+    def stop(self):
+        self._stop.set()
+
+    def pause(self):
+        pass
+
+    def resume(self):
+        pass
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self, *, force: bool = False):
+        self.stop()
+        self._connected = False
+
+
+def install():
+    """Replace yt_dlp and anthropic with the fakes. Call before importing any bot module."""
+    yt_dlp = types.ModuleType("yt_dlp")
+    yt_dlp.YoutubeDL = FakeYoutubeDL
+    anthropic = types.ModuleType("anthropic")
+    anthropic.AsyncAnthropic = FakeAsyncAnthropic
+    sys.modules["yt_dlp"] = yt_dlp
+    sys.modules["anthropic"] = anthropic
+
+
+def isolate(directory: Path):
+    """Point every on-disk path in config at ``directory``. Call before importing any bot module."""
+    import config
+
+    config.BASE_DIR = directory
+    config.MP3S_DIR = directory / "mp3s"
+    config.VIDEOS_DIR = directory / "videos"
+    config.PLAYLISTS_DIR = directory / "playlists"
+    config.TRACK_INDEX_PATH = directory / "tracks.db"
+    config.PLAYLIST_DB_PATH = config.PLAYLISTS_DIR / "playlists.db"
+    for path in (config.MP3S_DIR, config.VIDEOS_DIR, config.PLAYLISTS_DIR):
+        path.mkdir(parents=True, exist_ok=True)
+    # No FFmpeg offline: download before playing, and skip loudness analysis
+    config.STREAM_WHILE_DOWNLOADING = False
+    config.LOUDNESS_NORMALIZE = False
+    config.LOUDNESS_BACKFILL = False
+    config.METRICS_PORT = 0
@@ -0,0 +1,232 @@
+"""Offline benchmark suite.
+
+    python -m benchmarks.run [--only NAME ...] [--output results.json] [--extract-latency 0.2] ...
+
+Runs against a throwaway data directory with yt-dlp, Anthropic and the voice client
+replaced by the stand-ins in :mod:`benchmarks.fakes`, and prints one JSON document with
+per-benchmark timing summaries so runs can be diffed before and after an upgrade.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks import fakes
+
+PLAYLIST_SIZES = (10, 1_000, 10_000)
+
+
+def summarize(samples: list[float]) -> dict:
+    """Timing summary in milliseconds."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pct(p: float) -> float:
+        return round(ordered[min(int(p * len(ordered)), len(ordered) - 1)] * 1000, 3)
+
+    return {
+        "count": len(samples),
+        "mean_ms": round(statistics.fmean(samples) * 1000, 3),
+        "p50_ms": pct(0.50),
+        "p95_ms": pct(0.95),
+        "p99_ms": pct(0.99),
+        "min_ms": round(ordered[0] * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+        "total_s": round(sum(samples), 4),
+    }
+
+
+def _timed(fn, *args) -> float:
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+async def _timed_async(coro) -> float:
+    start = time.perf_counter()
+    await coro
+    return time.perf_counter() - start
+
+
+# --- download_and_convert -------------------------------------------------------
+
+def bench_download(iterations: int) -> dict:
+    from services.downloader import download_and_convert
+
+    # Every benchmark shares one track index, so each uses its own URLs and query strings; a
+    # query another benchmark already resolved would be answered from the query cache
+    urls = [f"https://www.youtube.com/watch?v=bench{n:06d}" for n in range(iterations)]
+    queries = [f"download artist {n} - download song {n}" for n in range(iterations)]
+    return {
+        "cache_miss_url": summarize([_timed(download_and_convert, url) for url in urls]),
+        "cache_hit_url": summarize([_timed(download_and_convert, url) for url in urls]),
+        "cache_miss_query": summarize([_timed(download_and_convert, q) for q in queries]),
+        "cache_hit_query": summarize([_timed(download_and_convert, q) for q in queries]),
+    }
+
+
+# --- Player transitions ----------------------------------------------------------
+
+async def bench_transitions(tracks: int) -> dict:
+    from services.downloader import download_and_convert
+    from services.player import get_player, release_player
+
+    queue = [download_and_convert(f"https://www.youtube.com/watch?v=trans{n:06d}") for n in range(tracks)]
+    player = get_player(900_001)
+    voice = fakes.FakeVoiceClient()
+    player.voice_client = voice
+    player.add_tracks(queue)
+
+    started = time.perf_counter()
+    await player.play_track(0, announce=False)
+    while voice.plays < tracks or voice.is_playing():
+        await asyncio.sleep(fakes.LATENCY.track / 4)
+    elapsed = time.perf_counter() - started
+
+    await release_player(player.guild_id)
+    return {"gap": summarize(voice.gaps), "tracks": tracks, "wall_s": round(elapsed, 4)}
+
+
+# --- Chillax --------------------------------------------------------------------
+
+async def bench_chillax(prefetches: int, rerolls: int) -> dict:
+    from services.downloader import download_and_convert
+    from services.player import get_player, release_player
+
+    saved_track_latency = fakes.LATENCY.track
+    fakes.LATENCY.track = 3600  # keep the seed track playing for the whole run
+    player = get_player(900_002)
+    player.voice_client = fakes.FakeVoiceClient()
+    try:
+        player.start_chillax(player.guild_id, "benchmark vibes")
+        player.add_track(download_and_convert("https://www.youtube.com/watch?v=chillseed00"))
+
+        # Time from a track starting to its successor being downloaded; each skip onto the
+        # prefetched track starts the next prefetch
+        start = time.perf_counter()
+        await player.play_track(0, announce=False)
+        await player._prefetch_task
+        prefetch = [time.perf_counter() - start]
+        for _ in range(prefetches - 1):
+            start = time.perf_counter()
+            await player.skip()
+            await player._prefetch_task
+            prefetch.append(time.perf_counter() - start)
+
+        reroll = [await _timed_async(player.reroll()) for _ in range(rerolls)]
+    finally:
+        fakes.LATENCY.track = saved_track_latency
+        await release_player(player.guild_id)
+    return {"prefetch": summarize(prefetch), "reroll": summarize(reroll)}
+
+
+# --- Playlists ------------------------------------------------------------------
+
+def bench_playlists(sizes: tuple[int, ...]) -> dict:
+    from services.downloader import Track
+    from services.playlist_store import get_playlist_store
+
+    store = get_playlist_store()
+    results = {}
+    for size in sizes:
+        name = f"bench-{size}"
+        tracks = [
+            Track(f"Song {n}", "Bench Artist", f"https://www.youtube.com/watch?v=pl{n:09d}",
+                  f"pl{n:09d}", f"/nonexistent/pl{n:09d}.opus", 180)
+            for n in range(size)
+        ]
+        store.create(1, name)
+        append = [_timed(store.append, 1, name, track) for track in tracks]
+        load = [_timed(store.tracks, 1, name) for _ in range(5)]
+        listing = [_timed(store.list_playlists, 1) for _ in range(5)]
+        results[str(size)] = {
+            "save_s": round(sum(append), 4),
+            "append": summarize(append),
+            "load": summarize(load),
+            "list": summarize(listing),
+        }
+    return results
+
+
+BENCHMARKS = ("download", "transitions", "chillax", "playlists")
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=Path(__file__).resolve().parent, timeout=5,
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+async def run(args: argparse.Namespace) -> dict:
+    selected = args.only or BENCHMARKS
+    results = {}
+    if "download" in selected:
+        results["download"] = await asyncio.to_thread(bench_download, args.iterations)
+    if "transitions" in selected:
+        results["transitions"] = await bench_transitions(args.tracks)
+    if "chillax" in selected:
+        results["chillax"] = await bench_chillax(args.prefetches, args.rerolls)
+    if "playlists" in selected:
+        sizes = tuple(s for s in PLAYLIST_SIZES if s <= args.max_playlist)
+        results["playlists"] = await asyncio.to_thread(bench_playlists, sizes)
+    return results
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, help="run only these benchmarks")
+    parser.add_argument("--output", type=Path, help="write the JSON results here instead of stdout")
+    parser.add_argument("--iterations", type=int, default=200, help="download_and_convert calls per path")
+    parser.add_argument("--tracks", type=int, default=50, help="tracks played in the transition benchmark")
+    parser.add_argument("--prefetches", type=int, default=20, help="chillax prefetches")
+    parser.add_argument("--rerolls", type=int, default=20, help="chillax rerolls")
+    parser.add_argument("--max-playlist", type=int, default=max(PLAYLIST_SIZES), help="largest playlist size")
+    parser.add_argument("--extract-latency", type=float, default=0.0, help="seconds per yt-dlp extraction")
+    parser.add_argument("--download-latency", type=float, default=0.0, help="seconds per yt-dlp download")
+    parser.add_argument("--recommend-latency", type=float, default=0.0, help="seconds per Claude call")
+    parser.add_argument("--track-seconds", type=float, default=0.05, help="seconds each fake track plays")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's log output")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    fakes.LATENCY.extract = args.extract_latency
+    fakes.LATENCY.download = args.download_latency
+    fakes.LATENCY.recommend = args.recommend_latency
+    fakes.LATENCY.track = args.track_seconds
+
+    with tempfile.TemporaryDirectory(prefix="musicbot-bench-", ignore_cleanup_errors=True) as tmp:
+        fakes.install()
+        fakes.isolate(Path(tmp))
+        results = asyncio.run(run(args))
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "latency": vars(fakes.LATENCY),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+"""Multi-guild soak simulator.
+
+    python -m benchmarks.soak --guilds 200 --duration 300 --output soak.json
+
+Drives the real ``cogs.music`` and ``cogs.playlists`` command callbacks for N simulated
+guilds doing mixed play/skip/chillax/reroll/playlist traffic, with fake interactions and
+voice clients and the offline yt-dlp and Anthropic stand-ins from :mod:`benchmarks.fakes`.
+Reports throughput, per-command latency, event-loop lag, download-pool saturation and
+RSS growth over time as JSON.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+from collections import defaultdict
+from pathlib import Path
+
+from benchmarks import fakes
+from benchmarks.run import summarize
+
+# (command, weight) for the traffic mix after a guild's opening /play
+TRAFFIC = (
+    ("play", 40),
+    ("skip", 20),
+    ("chillax", 6),
+    ("reroll", 10),
+    ("stopchillax", 4),
+    ("addtoplaylist", 12),
+    ("loadplaylist", 4),
+    ("listplaylists", 4),
+)
+
+_LOOP_LAG_INTERVAL = 0.1
+
+
+def _rss_bytes() -> int | None:
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def _mb(value: int | None) -> float | None:
+    return None if value is None else round(value / 2**20, 1)
+
+
+# --- Fake interactions -----------------------------------------------------------
+
+class _TextChannel:
+    def __init__(self, stats: Stats):
+        self._stats = stats
+
+    async def send(self, content: str | None = None, **kwargs):
+        self._stats.messages += 1
+
+
+class _Response:
+    def __init__(self):
+        self._done = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def send_message(self, content: str | None = None, **kwargs):
+        self._done = True
+
+    async def defer(self, **kwargs):
+        self._done = True
+
+
+class _Followup:
+    async def send(self, content: str | None = None, **kwargs):
+        pass
+
+
+class _VoiceChannel:
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+        self.name = f"voice-{channel_id}"
+        self.members = [types.SimpleNamespace(bot=False)]
+
+    async def connect(self, **kwargs) -> fakes.FakeVoiceClient:
+        return fakes.FakeVoiceClient(channel=self)
+
+
+class FakeInteraction:
+    def __init__(self, guild_id: int, voice_channel: _VoiceChannel, text_channel: _TextChannel):
+        self.guild_id = guild_id
+        self.user = types.SimpleNamespace(id=guild_id, voice=types.SimpleNamespace(channel=voice_channel))
+        self.channel = text_channel
+        self.response = _Response()
+        self.followup = _Followup()
+
+    async def edit_original_response(self, **kwargs):
+        pass
+
+
+# --- Measurements -----------------------------------------------------------------
+
+class Stats:
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+        self.commands = 0
+        self.messages = 0
+        self.loop_lag: list[float] = []
+
+
+async def _sample_loop_lag(stats: Stats, stop: asyncio.Event):
+    while not stop.is_set():
+        expected = time.perf_counter() + _LOOP_LAG_INTERVAL
+        await asyncio.sleep(_LOOP_LAG_INTERVAL)
+        stats.loop_lag.append(max(time.perf_counter() - expected, 0.0))
+
+
+async def _sample_timeline(stats: Stats, stop: asyncio.Event, interval: float, started: float) -> list[dict]:
+    from config import DOWNLOAD_WORKERS
+    from services.download_service import get_download_service
+    from services.player import _players
+
+    service = get_download_service()
+    timeline = []
+    window_start, commands_before, lag_before = time.perf_counter(), 0, 0
+    depth_max, busy, samples = 0, 0, 0
+    next_report = window_start + interval
+    while not stop.is_set():
+        await asyncio.sleep(_LOOP_LAG_INTERVAL)
+        depth_max = max(depth_max, service.queue_depth)
+        busy += service.running >= DOWNLOAD_WORKERS
+        samples += 1
+        now = time.perf_counter()
+        if now < next_report:
+            continue
+        lag = stats.loop_lag[lag_before:]
+        timeline.append({
+            "t_s": round(now - started, 1),
+            "commands_per_s": round((stats.commands - commands_before) / (now - window_start), 2),
+            "loop_lag_p99_ms": summarize(lag).get("p99_ms"),
+            "download_queue_max": depth_max,
+            "download_pool_saturation": round(busy / samples, 3) if samples else 0.0,
+            "players": len(_players),
+            "rss_mb": _mb(_rss_bytes()),
+        })
+        window_start, commands_before, lag_before = now, stats.commands, len(stats.loop_lag)
+        depth_max, busy, samples = 0, 0, 0
+        next_report = now + interval
+    return timeline
+
+
+# --- Traffic ----------------------------------------------------------------------
+
+async def _invoke(stats: Stats, name: str, callback, *args):
+    start = time.perf_counter()
+    try:
+        await callback(*args)
+    except Exception as e:
+        stats.errors[name] += 1
+        logging.getLogger(__name__).debug("%s failed: %s", name, e)
+    stats.latencies[name].append(time.perf_counter() - start)
+    stats.commands += 1
+
+
+async def _guild_session(guild_id: int, music, playlists, stats: Stats, args: argparse.Namespace, deadline: float):
+    rng = random.Random(args.seed + guild_id)
+    voice_channel = _VoiceChannel(guild_id)
+    text_channel = _TextChannel(stats)
+
+    def interaction() -> FakeInteraction:
+        return FakeInteraction(guild_id, voice_channel, text_channel)
+
+    def query() -> str:
+        # A shared pool, so guilds hit each other's cache and share in-flight downloads
+        n = rng.randrange(args.song_pool)
+        return f"soak artist {n} - soak song {n}"
+
+    await asyncio.sleep(rng.uniform(0, args.ramp))
+    await _invoke(stats, "createplaylist", playlists.create_playlist.callback, playlists, interaction(), "soak")
+    await _invoke(stats, "play", music.play.callback, music, interaction(), query())
+
+    commands, weights = zip(*TRAFFIC)
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(rng.uniform(args.think_min, args.think_max))
+        command = rng.choices(commands, weights)[0]
+        if command == "play":
+            await _invoke(stats, command, music.play.callback, music, interaction(), query())
+        elif command == "skip":
+            await _invoke(stats, command, music.skip.callback, music, interaction())
+        elif command == "chillax":
+            await _invoke(stats, command, music.chillax.callback, music, interaction(), f"soak vibe {guild_id % 7}")
+        elif command == "reroll":
+            await _invoke(stats, command, music.reroll.callback, music, interaction())
+        elif command == "stopchillax":
+            await _invoke(stats, command, music.stopchillax.callback, music, interaction())
+        elif command == "addtoplaylist":
+            await _invoke(stats, command, playlists.add_to_playlist.callback, playlists, interaction(), "soak", query())
+        elif command == "loadplaylist":
+            await _invoke(stats, command, playlists.load_playlist.callback, playlists, interaction(), "soak")
+        elif command == "listplaylists":
+            await _invoke(stats, command, playlists.list_playlists.callback, playlists, interaction())
+
+
+async def simulate(args: argparse.Namespace) -> dict:
+    from cogs.music import Music
+    from cogs.playlists import Playlists
+    from services.player import _players, release_player
+
+    loop = asyncio.get_running_loop()
+    bot = types.SimpleNamespace(loop=loop, user=types.SimpleNamespace(id=0))
+    music, playlists = Music(bot), Playlists(bot)
+    await playlists.cog_load()
+
+    stats = Stats()
+    stop = asyncio.Event()
+    rss_start = _rss_bytes()
+    started = time.perf_counter()
+    deadline = started + args.duration
+    lag_task = asyncio.create_task(_sample_loop_lag(stats, stop))
+    timeline_task = asyncio.create_task(_sample_timeline(stats, stop, args.report_interval, started))
+
+    sessions = [
+        asyncio.create_task(_guild_session(guild_id, music, playlists, stats, args, deadline))
+        for guild_id in range(1, args.guilds + 1)
+    ]
+    # Sessions finish their in-flight command after the deadline; don't let a slow one hang the run
+    _, pending = await asyncio.wait(sessions, timeout=args.duration + args.ramp + 60)
+    for task in pending:
+        task.cancel()
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    timeline = await timeline_task
+    await lag_task
+    rss_end = _rss_bytes()
+    for guild_id in list(_players):
+        await release_player(guild_id)
+
+    peak = max((point["rss_mb"] for point in timeline if point["rss_mb"] is not None), default=None)
+    return {
+        "duration_s": round(elapsed, 1),
+        "commands": stats.commands,
+        "throughput_per_s": round(stats.commands / elapsed, 2),
+        "messages_sent": stats.messages,
+        "errors": dict(stats.errors),
+        "commands_by_name": {
+            name: {**summarize(samples), "errors": stats.errors.get(name, 0)}
+            for name, samples in sorted(stats.latencies.items())
+        },
+        "loop_lag": summarize(stats.loop_lag),
+        "rss_mb": {
+            "start": _mb(rss_start),
+            "end": _mb(rss_end),
+            "peak": peak,
+            "growth": _mb(rss_end - rss_start) if rss_start is not None and rss_end is not None else None,
+        },
+        "timeline": timeline,
+    }
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--guilds", type=int, default=100, help="simulated guilds")
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds of traffic")
+    parser.add_argument("--ramp", type=float, default=5.0, help="seconds over which guilds join")
+    parser.add_argument("--think-min", type=float, default=1.0, help="minimum seconds between a guild's commands")
+    parser.add_argument("--think-max", type=float, default=5.0, help="maximum seconds between a guild's commands")
+    parser.add_argument("--song-pool", type=int, default=500, help="distinct songs requested across all guilds")
+    parser.add_argument("--report-interval", type=float, default=5.0, help="seconds per timeline point")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="write the JSON report here instead of stdout")
+    parser.add_argument("--extract-latency", type=float, default=0.3, help="seconds per yt-dlp extraction")
+    parser.add_argument("--download-latency", type=float, default=1.5, help="seconds per yt-dlp download")
+    parser.add_argument("--recommend-latency", type=float, default=1.0, help="seconds per Claude call")
+    parser.add_argument("--track-seconds", type=float, default=15.0, help="seconds each fake track plays")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's log output")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    fakes.LATENCY.extract = args.extract_latency
+    fakes.LATENCY.download = args.download_latency
+    fakes.LATENCY.recommend = args.recommend_latency
+    fakes.LATENCY.track = args.track_seconds
+
+    with tempfile.TemporaryDirectory(prefix="musicbot-soak-", ignore_cleanup_errors=True) as tmp:
+        fakes.install()
+        fakes.isolate(Path(tmp))
+        results = asyncio.run(simulate(args))
+
+    report = {
+        "guilds": args.guilds,
+        "latency": vars(fakes.LATENCY),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
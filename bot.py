@@ -1,47 +1,162 @@
+import time
+
+_STARTED = time.perf_counter()
+
 import asyncio
+import hashlib
+import json
 import logging
+import os
+from contextlib import contextmanager
 
 import discord
 from discord.ext import commands
 
-from config import BOT_TOKEN
+from config import (
+    ANTHROPIC_API_KEY,
+    AUTO_SHARD,
+    BOT_TOKEN,
+    COMMAND_GUILD_ID,
+    COMMAND_SYNC_STATE,
+    FORCE_COMMAND_SYNC,
+    METRICS_HOST,
+    METRICS_PORT,
+    PRIMARY_PROCESS,
+    SHARD_COUNT,
+    SHARD_IDS,
+)
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
 log = logging.getLogger(__name__)
 
-if not discord.opus.is_loaded():
-    import sys
-    _opus_candidates = (
-        ["/usr/lib/x86_64-linux-gnu/libopus.so.0"] if sys.platform == "linux"
-        else ["opus", "libopus-0", "libopus0"]
-    )
-    for _name in _opus_candidates:
-        try:
-            discord.opus.load_opus(_name)
-            break
-        except Exception:
-            continue
-    log.info("Opus loaded: %s", discord.opus.is_loaded())
+# Seconds spent in each startup phase, logged once the bot is ready
+_phases: dict[str, float] = {"imports": time.perf_counter() - _STARTED}
+
+
+@contextmanager
+def _phase(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases[name] = _phases.get(name, 0.0) + time.perf_counter() - start
+
+
+with _phase("opus"):
+    if not discord.opus.is_loaded():
+        import sys
+        _opus_candidates = (
+            ["/usr/lib/x86_64-linux-gnu/libopus.so.0"] if sys.platform == "linux"
+            else ["opus", "libopus-0", "libopus0"]
+        )
+        for _name in _opus_candidates:
+            try:
+                discord.opus.load_opus(_name)
+                break
+            except Exception:
+                continue
+        log.info("Opus loaded: %s", discord.opus.is_loaded())
 
 intents = discord.Intents.default()
 intents.message_content = True
 intents.voice_states = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+if AUTO_SHARD or SHARD_IDS:
+    # Guilds are routed to shards by Discord, so each guild's player lives in exactly one process
+    bot = commands.AutoShardedBot(
+        command_prefix="!",
+        intents=intents,
+        shard_count=SHARD_COUNT or None,
+        shard_ids=SHARD_IDS or None,
+    )
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents)
 
 COGS = ["cogs.music", "cogs.playlists"]
-GUILD = discord.Object(id=612359079351812127)
+GUILD = discord.Object(id=int(COMMAND_GUILD_ID)) if COMMAND_GUILD_ID else None
 
 
-@bot.event
-async def on_ready():
-    log.info("Logged in as %s (ID: %s)", bot.user, bot.user.id)
+_connect_started: float | None = None
+_warmup: asyncio.Task | None = None
+
+
+def _command_tree_hash() -> str:
+    payload = []
+    for command in sorted(bot.tree.get_commands(guild=GUILD), key=lambda c: c.name):
+        try:
+            payload.append(command.to_dict(bot.tree))
+        except TypeError:  # discord.py < 2.4
+            payload.append(command.to_dict())
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def _load_sync_state() -> dict:
     try:
+        return json.loads(COMMAND_SYNC_STATE.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_sync_state(state: dict):
+    tmp = COMMAND_SYNC_STATE.with_name(f"{COMMAND_SYNC_STATE.name}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(state, indent=2))
+    os.replace(tmp, COMMAND_SYNC_STATE)
+
+
+async def _sync_commands():
+    """Sync slash commands only if the tree differs from the last one synced for this application."""
+    if GUILD:
         bot.tree.copy_global_to(guild=GUILD)
-        synced = await bot.tree.sync(guild=GUILD)
-        log.info("Synced %d slash command(s) to guild", len(synced))
-    except Exception as e:
-        log.error("Failed to sync commands: %s", e)
+    key = f"{bot.application_id}:{GUILD.id if GUILD else 'global'}"
+    digest = _command_tree_hash()
+    state = _load_sync_state()
+    if state.get(key) == digest and not FORCE_COMMAND_SYNC:
+        log.info("Slash commands unchanged since last sync, skipping")
+        return
+    synced = await bot.tree.sync(guild=GUILD)
+    state[key] = digest
+    _save_sync_state(state)
+    log.info("Synced %d slash command(s) to %s", len(synced), "guild" if GUILD else "all guilds")
+
+
+async def _setup_hook():
+    # Runs once per process after login, unlike on_ready, which fires again after reconnects.
+    # Command sync is per application, not per shard: one process does it for the deployment.
+    global _connect_started
+    if PRIMARY_PROCESS:
+        with _phase("command sync"):
+            try:
+                await _sync_commands()
+            except Exception as e:
+                log.error("Failed to sync commands: %s", e)
+    _connect_started = time.perf_counter()
+
+
+bot.setup_hook = _setup_hook
+
+
+def _warm_backends():
+    """Import the slow backends off the event loop so the first /play or /chillax doesn't pay for it."""
+    start = time.perf_counter()
+    import yt_dlp  # noqa: F401
+    if ANTHROPIC_API_KEY:
+        import anthropic  # noqa: F401
+    log.info("Backends loaded in the background in %.2fs", time.perf_counter() - start)
+
+
+@bot.event
+async def on_ready():
+    global _connect_started, _warmup
+    log.info("Logged in as %s (ID: %s), shards %s", bot.user, bot.user.id, SHARD_IDS or "all")
+    if _connect_started is None:
+        return  # a reconnect; startup work is done
+    _phases["gateway"] = time.perf_counter() - _connect_started
+    _connect_started = None
+    total = time.perf_counter() - _STARTED
+    log.info(
+        "Ready in %.2fs (%s)", total, ", ".join(f"{name} {seconds:.2f}s" for name, seconds in _phases.items())
+    )
+    _warmup = asyncio.create_task(asyncio.to_thread(_warm_backends))
 
 
 async def main():
@@ -49,11 +164,29 @@ async def main():
         log.error("BOT_TOKEN not set. Copy .env.example to .env and add your token.")
         return
 
-    async with bot:
-        for cog in COGS:
-            await bot.load_extension(cog)
-            log.info("Loaded cog: %s", cog)
-        await bot.start(BOT_TOKEN)
+    metrics_runner = None
+    if METRICS_PORT:
+        from services.metrics import start_server
+        with _phase("metrics"):
+            try:
+                metrics_runner = await start_server(METRICS_HOST, METRICS_PORT)
+            except OSError as e:
+                log.error("Failed to start metrics endpoint: %s", e)
+
+    try:
+        async with bot:
+            with _phase("cogs"):
+                for cog in COGS:
+                    await bot.load_extension(cog)
+                    log.info("Loaded cog: %s", cog)
+            start = time.perf_counter()
+            await bot.login(BOT_TOKEN)
+            # login() runs the setup hook, which times command sync separately
+            _phases["login"] = time.perf_counter() - start - _phases.get("command sync", 0.0)
+            await bot.connect()
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
 
 
 if __name__ == "__main__":
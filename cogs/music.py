@@ -1,13 +1,18 @@
 from __future__ import annotations
 
+import asyncio
 import logging
+import time
 
 import discord
 from discord import app_commands
-from discord.ext import commands
+from discord.ext import commands, tasks
 
-from services.downloader import download_and_convert
-from services.player import get_player
+from config import IDLE_TIMEOUT, LOUDNESS_BACKFILL, LOUDNESS_NORMALIZE, PRIMARY_PROCESS, REAPER_INTERVAL
+
+from services.download_service import get_download_service
+from services.player import Player, get_player, handle_external_disconnect, reap_idle_players
+from utils.helpers import is_playlist_url
 
 log = logging.getLogger(__name__)
 
@@ -15,6 +20,30 @@ log = logging.getLogger(__name__)
 class Music(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        self._backfill: asyncio.Task | None = None
+
+    async def cog_load(self):
+        self.reap_idle.start()
+        if LOUDNESS_NORMALIZE and LOUDNESS_BACKFILL and PRIMARY_PROCESS:
+            self._backfill = asyncio.create_task(get_download_service().backfill_loudness())
+
+    async def cog_unload(self):
+        self.reap_idle.cancel()
+        if self._backfill:
+            self._backfill.cancel()
+
+    @tasks.loop(seconds=REAPER_INTERVAL)
+    async def reap_idle(self):
+        try:
+            await reap_idle_players(IDLE_TIMEOUT)
+        except Exception as e:
+            log.error("Idle reaping failed: %s", e)
+
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
+        # Disconnected by a moderator or a dropped connection: free the player right away
+        if member.id == self.bot.user.id and before.channel and after.channel is None:
+            await handle_external_disconnect(member.guild.id)
 
     @app_commands.command(name="join", description="Join your voice channel")
     async def join(self, interaction: discord.Interaction):
@@ -45,6 +74,7 @@ class Music(commands.Cog):
             await interaction.response.send_message("You must be in a voice channel.", ephemeral=True)
             return
 
+        started = time.perf_counter()
         player = get_player(interaction.guild_id)
         await interaction.response.defer(ephemeral=player.silent)
         player.text_channel = interaction.channel
@@ -55,8 +85,12 @@ class Music(commands.Cog):
             await interaction.followup.send(f"Failed to connect to voice channel: {e}")
             return
 
+        if is_playlist_url(query):
+            await self._play_playlist(interaction, player, query)
+            return
+
         try:
-            track = await self.bot.loop.run_in_executor(None, download_and_convert, query)
+            track = await get_download_service().resolve(query, interaction.guild_id)
         except Exception as e:
             await interaction.followup.send(f"Download failed: {e}")
             return
@@ -64,13 +98,43 @@ class Music(commands.Cog):
         position = player.add_track(track)
 
         if not player.is_playing:
-            await player.play_track(position, announce=False)
+            await player.play_track(position, announce=False, requested_at=started)
             await interaction.followup.send(f"Now playing: **[{track.title}]({track.url})** by {track.artist}")
         else:
             await interaction.followup.send(
                 f"Added to queue (#{position + 1}): **[{track.title}]({track.url})** by {track.artist}"
             )
 
+    async def _play_playlist(self, interaction: discord.Interaction, player: Player, url: str):
+        """Queue a playlist entry by entry as it is listed, starting playback on the first one."""
+        service = get_download_service()
+        queued = 0
+        starting: asyncio.Task | None = None
+        try:
+            async for track in service.iter_playlist(url, interaction.guild_id):
+                position = player.add_track(track)
+                # Dropped if a skip or /stop moves playback on before the download starts
+                service.cache_in_background(track, interaction.guild_id, stale=player._stale_check())
+                queued += 1
+                if queued == 1:
+                    if not player.is_playing:
+                        # Don't hold up the listing while the first track downloads
+                        starting = asyncio.create_task(player.play_track(position))
+                    await interaction.followup.send(
+                        f"Importing playlist, starting with **[{track.title}]({track.url})**..."
+                    )
+        except Exception as e:
+            log.error("Playlist import failed: %s", e)
+            await interaction.followup.send(f"Playlist import failed after {queued} track(s): {e}")
+            return
+
+        if not queued:
+            await interaction.followup.send("That playlist has no playable entries.")
+            return
+        await interaction.followup.send(f"Queued {queued} track(s) from the playlist.")
+        if starting:
+            await starting
+
     @app_commands.command(name="pause", description="Pause the current track")
     async def pause(self, interaction: discord.Interaction):
         player = get_player(interaction.guild_id)
@@ -152,9 +216,7 @@ class Music(commands.Cog):
 
         try:
             recommender = get_recommender()
-            search_query = await self.bot.loop.run_in_executor(
-                None, recommender.recommend_next, interaction.guild_id, prompt
-            )
+            search_query = await recommender.recommend_next(interaction.guild_id, prompt)
             if search_query is None:
                 player.stop_chillax()
                 await interaction.followup.send(
@@ -162,9 +224,7 @@ class Music(commands.Cog):
                 )
                 return
 
-            track = await self.bot.loop.run_in_executor(
-                None, download_and_convert, search_query
-            )
+            track = await get_download_service().resolve(search_query, interaction.guild_id)
         except Exception as e:
             player.stop_chillax()
             await interaction.followup.send(f"Chillax startup failed: {e}")
@@ -216,17 +276,20 @@ class Music(commands.Cog):
         state = "on" if player.silent else "off"
         await interaction.response.send_message(f"Silent mode **{state}**.", ephemeral=True)
 
-    @app_commands.command(name="clearcache", description="Clear the downloaded audio file cache")
+    @app_commands.command(name="clearcache", description="Clear cached audio not used by a queue or saved playlist")
     async def clearcache(self, interaction: discord.Interaction):
-        from config import MP3S_DIR, VIDEOS_DIR
+        from config import VIDEOS_DIR
+        from services.audio_cache import get_audio_cache
         import shutil
 
-        count = sum(1 for _ in MP3S_DIR.iterdir()) if MP3S_DIR.exists() else 0
-        shutil.rmtree(MP3S_DIR, ignore_errors=True)
+        await interaction.response.defer(ephemeral=True)
+        removed, kept = await self.bot.loop.run_in_executor(None, get_audio_cache().clear)
         shutil.rmtree(VIDEOS_DIR, ignore_errors=True)
-        MP3S_DIR.mkdir(parents=True, exist_ok=True)
         VIDEOS_DIR.mkdir(parents=True, exist_ok=True)
-        await interaction.response.send_message(f"Cleared {count} cached audio files.", ephemeral=True)
+        message = f"Cleared {removed} cached audio files."
+        if kept:
+            message += f" Kept {kept} still used by a queue or playlist."
+        await interaction.followup.send(message, ephemeral=True)
 
 
 async def setup(bot: commands.Bot):
@@ -1,134 +1,183 @@
 from __future__ import annotations
 
-import json
+import asyncio
 import logging
-from pathlib import Path
+import time
 
 import discord
 from discord import app_commands
 from discord.ext import commands
 
-from config import PLAYLISTS_DIR
-from services.downloader import Track, download_and_convert
+from services.audio_cache import register_pin_source
+from services.download_service import Priority, get_download_service
+from services.downloader import Track, relink_cached_audio
 from services.player import get_player
-from utils.helpers import sanitize_filename
+from services.playlist_store import PlaylistStore, get_playlist_store
+from utils.helpers import is_playlist_url
 
 log = logging.getLogger(__name__)
 
-# In-memory playlist storage: {name: [Track, ...]}
-_playlists: dict[str, list[Track]] = {}
+# Minimum seconds between edits of the /loadplaylist progress message
+_PROGRESS_EDIT_INTERVAL = 2.0
 
 
-def _playlist_path(name: str) -> Path:
-    return PLAYLISTS_DIR / f"{sanitize_filename(name)}.json"
+register_pin_source(lambda: get_playlist_store().audio_paths())
 
 
-def _save_playlist(name: str):
-    data = {
-        "name": name,
-        "tracks": [t.to_dict() for t in _playlists.get(name, [])],
-    }
-    _playlist_path(name).write_text(json.dumps(data, indent=2), encoding="utf-8")
+_downloads: set[asyncio.Task] = set()
 
 
-def _load_playlist(name: str) -> list[Track] | None:
-    path = _playlist_path(name)
-    if not path.exists():
-        return None
-    data = json.loads(path.read_text(encoding="utf-8"))
-    return [Track.from_dict(t) for t in data.get("tracks", [])]
+def _track_download(track: Track, guild_id: int):
+    """Download a newly saved track in the background and record where its audio landed."""
+    async def download():
+        try:
+            await get_download_service().ensure_downloaded(track, guild_id, Priority.BACKFILL)
+            await asyncio.to_thread(get_playlist_store().update_audio_path, track.video_id, track.mp3_path)
+        except Exception as e:
+            log.error("Background download of %s failed: %s", track.title, e)
+
+    task = asyncio.create_task(download())
+    _downloads.add(task)
+    task.add_done_callback(_downloads.discard)
+
+
+def _relink(store: PlaylistStore, tracks: list[Track]) -> list[Track]:
+    """Point tracks at audio that moved since they were saved; returns those with no audio left.
+
+    Touches the disk and the shared database, so it runs off the event loop.
+    """
+    missing = []
+    for track in tracks:
+        stored_path = track.mp3_path
+        if not relink_cached_audio(track):
+            missing.append(track)
+        elif track.mp3_path != stored_path:
+            store.update_audio_path(track.video_id, track.mp3_path)
+    return missing
 
 
 class Playlists(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
 
+    async def cog_load(self):
+        # Opening the database (and, on the primary process, importing legacy playlists) can
+        # wait on another worker's lock; do it off the loop before any command can run
+        await asyncio.to_thread(get_playlist_store)
+
     @app_commands.command(name="createplaylist", description="Create a new empty playlist")
     @app_commands.describe(name="Playlist name")
     async def create_playlist(self, interaction: discord.Interaction, name: str):
-        if name in _playlists:
+        if not await asyncio.to_thread(get_playlist_store().create, interaction.guild_id, name):
             await interaction.response.send_message(f"Playlist **{name}** already exists.", ephemeral=True)
             return
-        _playlists[name] = []
         await interaction.response.send_message(f"Created playlist: **{name}**")
 
     @app_commands.command(name="addtoplaylist", description="Add a song to a playlist")
     @app_commands.describe(name="Playlist name", query="YouTube URL or search query")
     async def add_to_playlist(self, interaction: discord.Interaction, name: str, query: str):
-        if name not in _playlists:
+        store = get_playlist_store()
+        if not await asyncio.to_thread(store.exists, interaction.guild_id, name):
             await interaction.response.send_message(f"Playlist **{name}** not found. Create it first.", ephemeral=True)
             return
 
         await interaction.response.defer()
 
+        if is_playlist_url(query):
+            await self._import_playlist(interaction, name, query)
+            return
+
         try:
-            track = await self.bot.loop.run_in_executor(None, download_and_convert, query)
+            track = await get_download_service().fetch(query, interaction.guild_id)
         except Exception as e:
             await interaction.followup.send(f"Failed to add track: {e}")
             return
 
-        _playlists[name].append(track)
+        count = await asyncio.to_thread(store.append, interaction.guild_id, name, track)
+        if count is None:
+            await interaction.followup.send(f"Playlist **{name}** was deleted or renamed meanwhile.")
+            return
         await interaction.followup.send(
-            f"Added **[{track.title}]({track.url})** to playlist **{name}** (#{len(_playlists[name])})"
+            f"Added **[{track.title}]({track.url})** to playlist **{name}** (#{count})"
+        )
+
+    async def _import_playlist(self, interaction: discord.Interaction, name: str, url: str):
+        """Append a YouTube playlist's entries as they are listed, downloading them in the background."""
+        store = get_playlist_store()
+        queued = 0
+        last_edit = 0.0
+        try:
+            async for track in get_download_service().iter_playlist(url, interaction.guild_id):
+                if await asyncio.to_thread(store.append, interaction.guild_id, name, track) is None:
+                    await interaction.followup.send(f"Playlist **{name}** was deleted or renamed meanwhile.")
+                    return
+                _track_download(track, interaction.guild_id)
+                queued += 1
+                now = time.monotonic()
+                if now - last_edit >= _PROGRESS_EDIT_INTERVAL:
+                    last_edit = now
+                    await interaction.edit_original_response(
+                        content=f"Importing into **{name}**: {queued} track(s) so far..."
+                    )
+        except Exception as e:
+            log.error("Playlist import failed: %s", e)
+            await interaction.edit_original_response(
+                content=f"Import into **{name}** failed after {queued} track(s): {e}"
+            )
+            return
+
+        await interaction.edit_original_response(
+            content=f"Added {queued} track(s) to playlist **{name}**. Audio is downloading in the background."
         )
 
     @app_commands.command(name="removefromplaylist", description="Remove a song from a playlist by index")
     @app_commands.describe(name="Playlist name", index="Track number (starting from 1)")
     async def remove_from_playlist(self, interaction: discord.Interaction, name: str, index: int):
-        if name not in _playlists:
+        store = get_playlist_store()
+        if not await asyncio.to_thread(store.exists, interaction.guild_id, name):
             await interaction.response.send_message(f"Playlist **{name}** not found.", ephemeral=True)
             return
 
-        tracks = _playlists[name]
-        idx = index - 1
-        if idx < 0 or idx >= len(tracks):
+        removed = await asyncio.to_thread(store.remove, interaction.guild_id, name, index - 1)
+        if removed is None:
+            count = dict(await asyncio.to_thread(store.list_playlists, interaction.guild_id)).get(name, 0)
             await interaction.response.send_message(
-                f"Invalid index. Playlist has {len(tracks)} track(s).", ephemeral=True
+                f"Invalid index. Playlist has {count} track(s).", ephemeral=True
             )
             return
 
-        removed = tracks.pop(idx)
         await interaction.response.send_message(f"Removed **{removed.title}** from **{name}**.")
 
     @app_commands.command(name="renameplaylist", description="Rename a playlist")
     @app_commands.describe(old="Current name", new="New name")
     async def rename_playlist(self, interaction: discord.Interaction, old: str, new: str):
-        if old not in _playlists:
+        store = get_playlist_store()
+        if not await asyncio.to_thread(store.exists, interaction.guild_id, old):
             await interaction.response.send_message(f"Playlist **{old}** not found.", ephemeral=True)
             return
-        if new in _playlists:
+        if not await asyncio.to_thread(store.rename, interaction.guild_id, old, new):
             await interaction.response.send_message(f"Playlist **{new}** already exists.", ephemeral=True)
             return
 
-        _playlists[new] = _playlists.pop(old)
-
-        old_path = _playlist_path(old)
-        if old_path.exists():
-            old_path.unlink()
-
         await interaction.response.send_message(f"Renamed **{old}** to **{new}**.")
 
     @app_commands.command(name="saveplaylists", description="Save all playlists to disk")
     async def save_playlists(self, interaction: discord.Interaction):
-        for name in _playlists:
-            _save_playlist(name)
-        await interaction.response.send_message(f"Saved {len(_playlists)} playlist(s) to disk.")
+        # Every playlist change is committed as it happens; this only reports what is stored
+        count = len(await asyncio.to_thread(get_playlist_store().list_playlists, interaction.guild_id))
+        await interaction.response.send_message(
+            f"{count} playlist(s) saved. Changes are written to disk automatically."
+        )
 
     @app_commands.command(name="listplaylists", description="List all saved playlists")
     async def list_playlists(self, interaction: discord.Interaction):
-        on_disk = [p.stem for p in PLAYLISTS_DIR.glob("*.json")]
-        in_memory = list(_playlists.keys())
-        all_names = sorted(set(on_disk + in_memory))
+        playlists = await asyncio.to_thread(get_playlist_store().list_playlists, interaction.guild_id)
 
-        if not all_names:
+        if not playlists:
             await interaction.response.send_message("No playlists found.")
             return
 
-        lines = []
-        for name in all_names:
-            count = len(_playlists[name]) if name in _playlists else "?"
-            lines.append(f"- **{name}** ({count} tracks)")
-
+        lines = [f"- **{name}** ({count} tracks)" for name, count in playlists]
         await interaction.response.send_message("\n".join(lines))
 
     @app_commands.command(name="loadplaylist", description="Load a saved playlist and start playing")
@@ -138,13 +187,11 @@ class Playlists(commands.Cog):
             await interaction.response.send_message("You must be in a voice channel.", ephemeral=True)
             return
 
-        tracks = _playlists.get(name)
+        store = get_playlist_store()
+        tracks = await asyncio.to_thread(store.tracks, interaction.guild_id, name)
         if tracks is None:
-            tracks = _load_playlist(name)
-            if tracks is None:
-                await interaction.response.send_message(f"Playlist **{name}** not found.", ephemeral=True)
-                return
-            _playlists[name] = tracks
+            await interaction.response.send_message(f"Playlist **{name}** not found.", ephemeral=True)
+            return
 
         if not tracks:
             await interaction.response.send_message(f"Playlist **{name}** is empty.", ephemeral=True)
@@ -161,14 +208,71 @@ class Playlists(commands.Cog):
             await interaction.followup.send(f"Failed to connect: {e}")
             return
 
+        # Preflight: relink audio that moved, and re-download whatever was evicted, in queue order
+        missing = await asyncio.to_thread(_relink, store, tracks)
+        service = get_download_service()
+        # The first track is what playback waits on; the rest trickle in behind live traffic once
+        # it has started
+        first = None
+        if missing and missing[0] is tracks[0]:
+            first = asyncio.create_task(
+                service.ensure_downloaded(tracks[0], interaction.guild_id, Priority.NOW_PLAYING)
+            )
+
         player.clear_queue()
-        for track in tracks:
-            player.add_track(track)
+        player.add_tracks(tracks)
+
+        status = f"Loaded playlist **{name}** ({len(tracks)} tracks)."
+        if first:
+            await interaction.edit_original_response(
+                content=f"{status} Re-downloading {len(missing)} missing track(s)..."
+            )
+            await asyncio.wait([first])
 
         await player.play_track(0)
-        await interaction.followup.send(
-            f"Loaded playlist **{name}** ({len(tracks)} tracks). Now playing: **{tracks[0].title}**"
-        )
+        status += f" Now playing: **{tracks[0].title}**"
+        if not missing:
+            await interaction.edit_original_response(content=status)
+            return
+
+        # Taken after play_track, which moves the generation on when it replaces a playing track;
+        # a later skip or /stop drops the repairs that have not started yet
+        stale = player._stale_check()
+        repairs = [first] if first else []
+        repairs += [
+            asyncio.create_task(service.ensure_downloaded(t, interaction.guild_id, Priority.BACKFILL, stale))
+            for t in missing if t is not tracks[0]
+        ]
+
+        done = failed = dropped = 0
+        last_edit = 0.0
+        # A long repair can outlive the interaction token; progress updates then just stop
+        reporting = True
+        for repair in asyncio.as_completed(repairs):
+            try:
+                track = await repair
+                await asyncio.to_thread(store.update_audio_path, track.video_id, track.mp3_path)
+            except asyncio.CancelledError:
+                if not stale():
+                    raise
+                dropped += 1
+            except Exception as e:
+                failed += 1
+                log.error("Playlist preflight download failed: %s", e)
+            done += 1
+            now = time.monotonic()
+            if reporting and (done == len(missing) or now - last_edit >= _PROGRESS_EDIT_INTERVAL):
+                last_edit = now
+                progress = f"Repaired {done - failed - dropped}/{len(missing)} missing track(s)"
+                if failed:
+                    progress += f", {failed} failed"
+                if dropped:
+                    progress += f", {dropped} skipped after playback moved on"
+                try:
+                    await interaction.edit_original_response(content=f"{status}\n{progress}.")
+                except discord.HTTPException as e:
+                    log.warning("Stopped reporting playlist repair progress: %s", e)
+                    reporting = False
 
 
 async def setup(bot: commands.Bot):
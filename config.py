@@ -16,3 +16,94 @@ MP3S_DIR = BASE_DIR / "mp3s"
 VIDEOS_DIR.mkdir(exist_ok=True)
 MP3S_DIR.mkdir(exist_ok=True)
 PLAYLISTS_DIR.mkdir(exist_ok=True)
+
+# SQLite index of downloaded tracks, used to answer cache hits without yt-dlp
+TRACK_INDEX_PATH = BASE_DIR / "tracks.db"
+
+# Search query -> video_id resolution cache
+QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", str(7 * 24 * 3600)))
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_CACHE_MAX_ENTRIES", "10000"))
+
+# Dedicated download worker pool (separate from the event loop's default executor)
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "4"))
+
+# Start playback from the remote stream while the cache copy downloads in the background
+STREAM_WHILE_DOWNLOADING = os.getenv("STREAM_WHILE_DOWNLOADING", "true").lower() in ("1", "true", "yes")
+
+# Audio cache size budget in MB; least recently played unpinned files are evicted past it (0 = unlimited)
+AUDIO_CACHE_MAX_MB = int(os.getenv("AUDIO_CACHE_MAX_MB", "10240"))
+
+# Chillax recommendations: songs requested per API call, and buffer size that triggers a background refill
+RECOMMEND_BATCH_SIZE = int(os.getenv("RECOMMEND_BATCH_SIZE", "5"))
+RECOMMEND_LOW_WATER = int(os.getenv("RECOMMEND_LOW_WATER", "2"))
+
+# Chillax recommendation API limits: per-call deadline in seconds and max concurrent calls
+RECOMMEND_TIMEOUT = float(os.getenv("RECOMMEND_TIMEOUT", "10"))
+RECOMMEND_CONCURRENCY = int(os.getenv("RECOMMEND_CONCURRENCY", "4"))
+
+# Number of upcoming queue entries downloaded ahead of the play cursor
+PREFETCH_LOOKAHEAD = int(os.getenv("PREFETCH_LOOKAHEAD", "3"))
+
+# Transactional playlist store (legacy per-playlist JSON files are imported on first start)
+PLAYLIST_DB_PATH = PLAYLISTS_DIR / "playlists.db"
+
+# Maximum entries taken from one YouTube playlist or mix by /play and /addtoplaylist
+BULK_IMPORT_MAX = int(os.getenv("BULK_IMPORT_MAX", "200"))
+
+# Played tracks kept behind the play cursor for /previous; older ones are dropped
+QUEUE_HISTORY = int(os.getenv("QUEUE_HISTORY", "50"))
+
+# Players with no playback (or nobody listening) for this many seconds are disconnected and freed
+IDLE_TIMEOUT = int(os.getenv("IDLE_TIMEOUT", "300"))
+REAPER_INTERVAL = int(os.getenv("REAPER_INTERVAL", "30"))
+
+# Loudness normalization, measured once per download and baked into the cached file
+LOUDNESS_NORMALIZE = os.getenv("LOUDNESS_NORMALIZE", "true").lower() in ("1", "true", "yes")
+LOUDNESS_TARGET_LUFS = float(os.getenv("LOUDNESS_TARGET_LUFS", "-14"))
+LOUDNESS_TOLERANCE_DB = float(os.getenv("LOUDNESS_TOLERANCE_DB", "1.5"))
+LOUDNESS_BACKFILL = os.getenv("LOUDNESS_BACKFILL", "true").lower() in ("1", "true", "yes")
+
+# Prometheus metrics endpoint (http://METRICS_HOST:METRICS_PORT/metrics); port 0 disables it
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+
+# Sharding. AUTO_SHARD runs an AutoShardedBot; SHARD_COUNT is the total across all processes
+# (0 lets Discord recommend one) and SHARD_IDS the comma-separated shards this process runs
+# (empty = all of them). launcher.py sets these for each worker process.
+AUTO_SHARD = os.getenv("AUTO_SHARD", "false").lower() in ("1", "true", "yes")
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0"))
+SHARD_IDS = [int(s) for s in os.getenv("SHARD_IDS", "").split(",") if s.strip()]
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "1"))
+# The process that runs shard 0 also does once-per-deployment work: command sync, legacy
+# playlist import, loudness backfill
+PRIMARY_PROCESS = not SHARD_IDS or 0 in SHARD_IDS
+if SHARD_IDS and SHARD_COUNT <= 0:
+    raise ValueError("SHARD_IDS is set but SHARD_COUNT is not; set SHARD_COUNT to the total shard count")
+if any(not 0 <= shard < SHARD_COUNT for shard in SHARD_IDS):
+    raise ValueError(f"SHARD_IDS {SHARD_IDS} must all be below SHARD_COUNT ({SHARD_COUNT})")
+
+# Guild slash commands are synced to for instant updates; empty syncs them globally instead
+COMMAND_GUILD_ID = os.getenv("COMMAND_GUILD_ID", "612359079351812127")
+
+# Seconds a process waits on another process's lock of a shared SQLite database
+SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", "30"))
+
+# Seconds to wait for another thread or process already downloading the same video before
+# downloading it anyway
+DOWNLOAD_LOCK_TIMEOUT = float(os.getenv("DOWNLOAD_LOCK_TIMEOUT", "600"))
+
+# Hash of the last synced slash command tree; commands are only re-synced when it changes
+COMMAND_SYNC_STATE = BASE_DIR / "command_sync.json"
+FORCE_COMMAND_SYNC = os.getenv("FORCE_COMMAND_SYNC", "false").lower() in ("1", "true", "yes")
+
+# Seconds a background download class goes unserved before it is treated as one class more
+# urgent, up to look-ahead, so backfill still progresses under constant prefetching (0 disables aging)
+DOWNLOAD_PRIORITY_AGING = float(os.getenv("DOWNLOAD_PRIORITY_AGING", "20"))
+
+# FFmpeg transcode pool for batch work (download conversion, loudness analysis and gain):
+# concurrent process cap for the whole host (shared by launcher.py workers), niceness, CPU cores they may use (comma-separated, empty = all)
+# and seconds after which a hung process is killed. Playback processes are not capped.
+FFMPEG_MAX_PROCESSES = int(os.getenv("FFMPEG_MAX_PROCESSES", str(max(1, (os.cpu_count() or 2) // 2))))
+FFMPEG_NICE = int(os.getenv("FFMPEG_NICE", "10"))
+FFMPEG_CPU_AFFINITY = [int(c) for c in os.getenv("FFMPEG_CPU_AFFINITY", "").split(",") if c.strip()]
+FFMPEG_TIMEOUT = float(os.getenv("FFMPEG_TIMEOUT", "300"))
@@ -0,0 +1,153 @@
+"""Run the bot as several worker processes, each with its own range of shards.
+
+    python launcher.py --processes 4 [--shards 16]
+
+Each worker is a normal ``bot.py`` process running an AutoShardedBot for its shard range,
+so voice encoding, players and download pools are spread over several interpreters. All
+workers share the audio cache, track index and playlist database. Crashed workers are
+restarted; Ctrl+C stops them all.
+"""
+import argparse
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+from pathlib import Path
+
+from config import BOT_TOKEN, METRICS_PORT, SHARD_COUNT, WORKER_PROCESSES
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+log = logging.getLogger("launcher")
+
+BOT_SCRIPT = Path(__file__).resolve().parent / "bot.py"
+# A worker that dies sooner than this after starting is restarted with a growing delay
+_MIN_HEALTHY_SECONDS = 60
+_MAX_RESTART_DELAY = 300
+
+
+def recommended_shards(token: str) -> int:
+    request = urllib.request.Request(
+        "https://discord.com/api/v10/gateway/bot",
+        headers={"Authorization": f"Bot {token}", "User-Agent": "DiscordBot (discomusicbot launcher)"},
+    )
+    with urllib.request.urlopen(request, timeout=15) as response:
+        return int(json.load(response)["shards"])
+
+
+def shard_ranges(shards: int, processes: int) -> list[list[int]]:
+    """Split shard ids into contiguous, near-equal ranges, one per process."""
+    processes = max(1, min(processes, shards))
+    size, extra = divmod(shards, processes)
+    ranges, start = [], 0
+    for i in range(processes):
+        end = start + size + (1 if i < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+class Worker:
+    def __init__(self, index: int, shard_ids: list[int], shard_count: int):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.process: subprocess.Popen | None = None
+        self.started_at = 0.0
+        self.restart_delay = 5.0
+        self.restart_at: float | None = None
+
+    def start(self):
+        env = dict(os.environ)
+        env.update(
+            AUTO_SHARD="1",
+            SHARD_COUNT=str(self.shard_count),
+            SHARD_IDS=",".join(map(str, self.shard_ids)),
+            # One metrics endpoint per worker
+            METRICS_PORT=str(METRICS_PORT + self.index if METRICS_PORT else 0),
+        )
+        self.process = subprocess.Popen([sys.executable, str(BOT_SCRIPT)], env=env)
+        self.started_at = time.monotonic()
+        self.restart_at = None
+        log.info("Worker %d started (pid %d, shards %s)", self.index, self.process.pid, env["SHARD_IDS"])
+
+    def poll(self):
+        if self.process is None:
+            return
+        if self.restart_at is not None:
+            if time.monotonic() >= self.restart_at:
+                self.start()
+            return
+        code = self.process.poll()
+        if code is None:
+            return
+        if time.monotonic() - self.started_at >= _MIN_HEALTHY_SECONDS:
+            self.restart_delay = 5.0
+        log.error("Worker %d exited with code %s, restarting in %.0fs", self.index, code, self.restart_delay)
+        self.restart_at = time.monotonic() + self.restart_delay
+        self.restart_delay = min(self.restart_delay * 2, _MAX_RESTART_DELAY)
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+
+    def wait(self, timeout: float):
+        if self.process is None:
+            return
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=WORKER_PROCESSES, help="worker processes to run")
+    parser.add_argument("--shards", type=int, default=SHARD_COUNT,
+                        help="total shard count (default: Discord's recommendation)")
+    args = parser.parse_args()
+
+    if not BOT_TOKEN:
+        log.error("BOT_TOKEN not set. Copy .env.example to .env and add your token.")
+        return
+
+    shards = args.shards
+    if shards <= 0:
+        shards = recommended_shards(BOT_TOKEN)
+        log.info("Discord recommends %d shard(s)", shards)
+    # Never fewer shards than processes, or some processes would have nothing to run
+    shards = max(shards, args.processes)
+
+    workers = [Worker(i, ids, shards) for i, ids in enumerate(shard_ranges(shards, args.processes))]
+    stopping = False
+
+    def request_stop(*_):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    for worker in workers:
+        worker.start()
+        # Stagger logins; Discord rate-limits identifies
+        time.sleep(5)
+        if stopping:
+            break
+    while not stopping:
+        for worker in workers:
+            worker.poll()
+        time.sleep(1)
+
+    log.info("Stopping %d worker(s)", len(workers))
+    for worker in workers:
+        worker.stop()
+    for worker in workers:
+        worker.wait(15)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import logging
+import struct
+from pathlib import Path
+from typing import Callable
+
+import discord
+from discord.oggparse import OggError, OggStream
+
+from services.transcode import TrackedFFmpegOpusAudio
+
+log = logging.getLogger(__name__)
+
+# Discord sends one 20 ms Opus packet per voice frame
+_DISCORD_FRAME_MS = 20
+
+
+def _opus_packet_ms(packet: bytes) -> float:
+    """Duration of an Opus packet from its TOC byte (RFC 6716 section 3.1)."""
+    toc = packet[0]
+    config = toc >> 3
+    if config < 12:
+        frame_ms = (10, 20, 40, 60)[config % 4]
+    elif config < 16:
+        frame_ms = (10, 20)[config % 2]
+    else:
+        frame_ms = (2.5, 5, 10, 20)[config % 4]
+    code = toc & 0x03
+    if code == 0:
+        frames = 1
+    elif code in (1, 2):
+        frames = 2
+    else:
+        frames = packet[1] & 0x3F if len(packet) > 1 else 0
+    return frame_ms * frames
+
+
+def can_passthrough(path: str | Path) -> bool:
+    """Whether an Ogg file holds Opus that Discord can take as-is (48 kHz, 20 ms packets)."""
+    try:
+        with open(path, "rb") as f:
+            packets = OggStream(f).iter_packets()
+            head = next(packets, b"")
+            next(packets, None)  # OpusTags
+            first = next(packets, b"")
+    except (OSError, OggError):
+        return False
+
+    if len(head) < 19 or not head.startswith(b"OpusHead") or not first:
+        return False
+    channels = head[9]
+    input_rate = struct.unpack_from("<I", head, 12)[0]
+    mapping_family = head[18]
+    return (
+        channels in (1, 2)
+        and mapping_family == 0
+        and input_rate in (0, 48000)
+        and _opus_packet_ms(first) == _DISCORD_FRAME_MS
+    )
+
+
+class OggOpusAudio(discord.AudioSource):
+    """Plays a cached Ogg Opus file by handing its packets straight to the voice client.
+
+    No FFmpeg process and no re-encode; only valid for files accepted by :func:`can_passthrough`.
+    """
+
+    def __init__(self, path: str | Path):
+        self._file = open(path, "rb")
+        self._packets = OggStream(self._file).iter_packets()
+        # Skip the OpusHead and OpusTags header packets
+        next(self._packets, None)
+        next(self._packets, None)
+
+    def read(self) -> bytes:
+        try:
+            return next(self._packets, b"")
+        except OggError as e:
+            log.error("Corrupt Ogg page in %s: %s", self._file.name, e)
+            return b""
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self):
+        self._file.close()
+
+
+class PrimedAudio(discord.AudioSource):
+    """Wraps a source whose first packet has already been read, so playback starts without
+    waiting on file opens, FFmpeg spawn or stream probing. Construct it off the event loop."""
+
+    def __init__(self, source: discord.AudioSource):
+        self._source = source
+        self._first: bytes | None = source.read()
+
+    def read(self) -> bytes:
+        if self._first is not None:
+            first, self._first = self._first, None
+            return first
+        return self._source.read()
+
+    def is_opus(self) -> bool:
+        return self._source.is_opus()
+
+    def cleanup(self):
+        self._source.cleanup()
+
+
+class FirstReadAudio(discord.AudioSource):
+    """Wraps a source to call ``callback`` once, from the voice thread, when the first packet
+    is read for sending."""
+
+    def __init__(self, source: discord.AudioSource, callback: Callable[[], None]):
+        self._source = source
+        self._callback: Callable[[], None] | None = callback
+
+    def read(self) -> bytes:
+        data = self._source.read()
+        if data and self._callback is not None:
+            callback, self._callback = self._callback, None
+            callback()
+        return data
+
+    def is_opus(self) -> bool:
+        return self._source.is_opus()
+
+    def cleanup(self):
+        self._source.cleanup()
+
+
+def open_audio_source(path: str | Path, guild_id: int | None = None) -> discord.AudioSource:
+    """Open a cached audio file, skipping FFmpeg whenever the Opus can be passed through."""
+    if str(path).endswith(".opus") and can_passthrough(path):
+        return OggOpusAudio(path)
+    log.info("Transcoding %s through FFmpeg", path)
+    return TrackedFFmpegOpusAudio(str(path), guild_id=guild_id, before_options="-nostdin")
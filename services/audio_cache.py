@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterable
+
+from config import AUDIO_CACHE_MAX_MB, MP3S_DIR
+from services.track_index import get_track_index
+
+log = logging.getLogger(__name__)
+
+AUDIO_EXTENSIONS = (".opus", ".mp3")
+
+# Callables returning audio paths that must never be evicted (live queues, saved playlists)
+_pin_sources: list[Callable[[], Iterable[str]]] = []
+
+
+def register_pin_source(source: Callable[[], Iterable[str]]):
+    _pin_sources.append(source)
+
+
+# Other bot processes add files too, so the running total is recounted at least this often
+_RESCAN_INTERVAL = 60.0
+
+
+def _norm(path: str | Path) -> str:
+    return os.path.normcase(os.path.abspath(path))
+
+
+def _size(path: Path) -> int:
+    try:
+        return path.stat().st_size
+    except FileNotFoundError:  # removed by another process meanwhile
+        return 0
+
+
+class AudioCache:
+    """Byte-budgeted audio cache under MP3S_DIR with least-recently-played eviction.
+
+    Files live in two-character shard directories keyed by video id so no single
+    directory grows into a huge flat listing. Several bot processes may share one cache
+    directory; each only pins its own queues, so a file one process evicts from under another
+    is simply downloaded again by the process that needs it.
+    """
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total: int | None = None
+        self._scanned_at = 0.0
+
+    def path_for(self, video_id: str, filename: str) -> Path:
+        shard = self.root / video_id[:2]
+        shard.mkdir(exist_ok=True)
+        return shard / filename
+
+    def files(self) -> list[Path]:
+        """Every cached audio file, flat (pre-sharding) and sharded."""
+        # Dot-prefixed entries are in-progress downloads, normalization scratch files and locks
+        return [
+            p for p in self.root.rglob("*")
+            if p.suffix in AUDIO_EXTENSIONS
+            and not any(part.startswith(".") for part in p.relative_to(self.root).parts)
+            and p.is_file()
+        ]
+
+    def _pinned(self) -> set[str] | None:
+        pinned = set()
+        for source in _pin_sources:
+            try:
+                pinned.update(_norm(p) for p in source() if p)
+            except Exception as e:
+                log.error("Cache pin source failed, evicting nothing this round: %s", e)
+                return None
+        return pinned
+
+    def touch(self, video_id: str):
+        get_track_index().touch(video_id)
+
+    def note_added(self, path: Path):
+        """Account for a newly published file and evict if that pushed us over budget."""
+        with self._lock:
+            if self._total is None or time.monotonic() - self._scanned_at > _RESCAN_INTERVAL:
+                self._total = sum(_size(p) for p in self.files())
+                self._scanned_at = time.monotonic()
+            else:
+                self._total += _size(path)
+        self.enforce()
+
+    def enforce(self):
+        if self.max_bytes <= 0:
+            return
+        with self._lock:
+            if self._total is not None and self._total <= self.max_bytes:
+                return
+            files = self.files()
+            self._total = sum(_size(p) for p in files)
+            self._scanned_at = time.monotonic()
+            if self._total <= self.max_bytes:
+                return
+
+            pinned = self._pinned()
+            if pinned is None:
+                return
+            usage = {_norm(path): stats for path, stats in get_track_index().usage().items()}
+
+            def recency(path: Path) -> tuple[float, int]:
+                # Files the index doesn't know about fall back to their modification time
+                stats = usage.get(_norm(path))
+                if stats is None:
+                    try:
+                        stats = (path.stat().st_mtime, 0)
+                    except FileNotFoundError:
+                        stats = (0.0, 0)
+                return stats
+
+            evicted = 0
+            for path in sorted(files, key=recency):
+                if self._total <= self.max_bytes:
+                    break
+                if _norm(path) in pinned:
+                    continue
+                self._total -= self._remove(path)
+                evicted += 1
+            log.info("Cache eviction removed %d file(s), %d MB in use", evicted, self._total // 2**20)
+
+    def clear(self) -> tuple[int, int]:
+        """Remove every unpinned file. Returns (removed, kept)."""
+        with self._lock:
+            pinned = self._pinned()
+            if pinned is None:
+                return 0, 0
+            removed = kept = 0
+            for path in self.files():
+                if _norm(path) in pinned:
+                    kept += 1
+                    continue
+                self._remove(path)
+                if path.exists():
+                    kept += 1
+                else:
+                    removed += 1
+            self._total = None
+        return removed, kept
+
+    def _remove(self, path: Path) -> int:
+        size = _size(path)
+        try:
+            path.unlink(missing_ok=True)
+        except OSError as e:
+            # Windows won't delete a file another process is playing; it goes in a later round
+            log.warning("Could not evict %s: %s", path.name, e)
+            return 0
+        get_track_index().forget_path(str(path))
+        return size
+
+
+_cache: AudioCache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_audio_cache() -> AudioCache:
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = AudioCache(MP3S_DIR, AUDIO_CACHE_MAX_MB * 2**20)
+    return _cache
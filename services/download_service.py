@@ -0,0 +1,341 @@
+from __future__ import annotations
+
+import asyncio
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any, AsyncIterator, Callable
+
+from config import DOWNLOAD_PRIORITY_AGING, DOWNLOAD_WORKERS
+from services.downloader import Track, download_and_convert, download_resolved, iter_playlist, resolve
+from services.metrics import DOWNLOAD_QUEUE_DEPTH, DOWNLOAD_RUNNING
+from services.track_index import get_track_index
+from services.transcode import guild_scope
+from utils.helpers import extract_video_id, is_youtube_url, normalize_query, normalize_url
+
+log = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    """Download job classes, most urgent first."""
+    NOW_PLAYING = 0  # playback is waiting on it
+    INTERACTIVE = 1  # a slash command is waiting on it
+    LOOKAHEAD = 2  # upcoming queue entries
+    BACKFILL = 3  # bulk imports, cache copies of streamed tracks, maintenance
+
+
+# Aging lifts background work at most to this class, never past what a listener waits on
+_AGING_CEILING = Priority.LOOKAHEAD
+
+
+@dataclass
+class _Job:
+    key: str
+    fn: Callable[..., Any]
+    args: tuple
+    future: asyncio.Future
+    priority: Priority
+    guild_id: int | None
+    enqueued_at: float = field(default_factory=time.monotonic)
+    # One check per requester; the job is dropped before it runs if every requester has
+    # moved on. None once any requester joined without a check.
+    stale_checks: list[Callable[[], bool]] | None = None
+
+    def is_stale(self) -> bool:
+        return bool(self.stale_checks) and all(check() for check in self.stale_checks)
+
+
+# Extracted info kept between resolve() and the background download, so the download
+# doesn't have to extract the page again
+_MAX_RESOLVED_INFO = 256
+
+# Playlist listings are never deduplicated; each gets its own job key
+_listing_ids = itertools.count()
+
+
+def _dedupe_key(query: str) -> str:
+    """Best local guess at which video a query refers to, so identical requests share one download.
+
+    Reads the shared track index, which another process may hold locked; call it off the event loop.
+    """
+    if is_youtube_url(query):
+        video_id = extract_video_id(query)
+        return f"id:{video_id}" if video_id else f"url:{normalize_url(query)}"
+    normalized = normalize_query(query)
+    video_id = get_track_index().resolve_query(normalized)
+    return f"id:{video_id}" if video_id else f"q:{normalized}"
+
+
+class DownloadService:
+    """Bounded download pool with priority classes, round-robin fairness across guilds within
+    a class, and single-flight per video.
+
+    The most urgent class with queued work is served first. Backfill that has gone unserved
+    ages towards look-ahead (one class per ``DOWNLOAD_PRIORITY_AGING`` seconds) so it is not
+    starved by prefetching, but never overtakes now-playing or interactive work.
+    """
+
+    def __init__(self, max_workers: int = DOWNLOAD_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="download")
+        self._max_workers = max_workers
+        self._running = 0
+        # priority -> guild_id -> queued jobs; within a class the front guild is served next,
+        # then rotated to the back
+        self._pending: dict[Priority, OrderedDict[int | None, deque[_Job]]] = {p: OrderedDict() for p in Priority}
+        self._queued: dict[str, _Job] = {}
+        self._served_at: dict[Priority, float] = {}
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._resolved_info: OrderedDict[str, dict] = OrderedDict()
+        self._background: set[asyncio.Task] = set()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queued)
+
+    def queue_depths(self) -> dict[Priority, int]:
+        return {p: sum(len(jobs) for jobs in guilds.values()) for p, guilds in self._pending.items()}
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    async def fetch(
+        self,
+        query: str,
+        guild_id: int | None = None,
+        priority: Priority = Priority.INTERACTIVE,
+        stale: Callable[[], bool] | None = None,
+    ) -> Track:
+        """Resolve and fully download a query.
+
+        ``stale`` is polled before the job starts; if it (and every other requester's check)
+        returns True, the job is cancelled instead of run.
+        """
+        key = await asyncio.to_thread(_dedupe_key, query)
+        return await self._submit(key, guild_id, download_and_convert, query, priority=priority, stale=stale)
+
+    async def resolve(self, query: str, guild_id: int | None = None, priority: Priority = Priority.INTERACTIVE) -> Track:
+        """Resolve a query without downloading; uncached tracks come back with a ``stream_url``."""
+        key = await asyncio.to_thread(_dedupe_key, query)
+        track, info = await self._submit(f"resolve:{key}", guild_id, resolve, query, priority=priority)
+        if info is not None:
+            self._resolved_info[track.video_id] = info
+            while len(self._resolved_info) > _MAX_RESOLVED_INFO:
+                self._resolved_info.popitem(last=False)
+        return track
+
+    async def ensure_downloaded(
+        self,
+        track: Track,
+        guild_id: int | None = None,
+        priority: Priority = Priority.INTERACTIVE,
+        stale: Callable[[], bool] | None = None,
+    ) -> Track:
+        """Make sure a Track's audio is in the cache, downloading it if needed."""
+        if track.has_audio:
+            return track
+        info = self._resolved_info.pop(track.video_id, None)
+        if info is None:
+            result = await self.fetch(track.url, guild_id, priority, stale)
+        else:
+            result = await self._submit(
+                f"id:{track.video_id}", guild_id, download_resolved, track, info, priority=priority, stale=stale
+            )
+        track.mp3_path = result.mp3_path
+        track.loudness, track.peak, track.gain = result.loudness, result.peak, result.gain
+        return track
+
+    async def iter_playlist(self, url: str, guild_id: int | None = None) -> AsyncIterator[Track]:
+        """Stream a playlist's entries as they are listed; the listing runs on one pool worker."""
+        loop = asyncio.get_running_loop()
+        entries: asyncio.Queue[Track | None] = asyncio.Queue()
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for track in iter_playlist(url):
+                    if stop.is_set():
+                        break
+                    loop.call_soon_threadsafe(entries.put_nowait, track)
+            finally:
+                loop.call_soon_threadsafe(entries.put_nowait, None)
+
+        listing = asyncio.create_task(self._submit(f"playlist:{next(_listing_ids)}", guild_id, produce))
+        try:
+            while (track := await entries.get()) is not None:
+                yield track
+            await listing  # surface extraction errors
+        finally:
+            stop.set()
+
+    def cache_in_background(
+        self,
+        track: Track,
+        guild_id: int | None = None,
+        priority: Priority = Priority.BACKFILL,
+        stale: Callable[[], bool] | None = None,
+    ):
+        """Download a track's audio without waiting for it; ``stale`` as for :meth:`fetch`."""
+        task = asyncio.create_task(self._cache_quietly(track, guild_id, priority, stale))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _cache_quietly(
+        self, track: Track, guild_id: int | None, priority: Priority, stale: Callable[[], bool] | None
+    ):
+        try:
+            await self.ensure_downloaded(track, guild_id, priority, stale)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            log.error("Background download of %s failed: %s", track.video_id, e)
+
+    async def backfill_loudness(self):
+        """Analyze cached files that predate loudness analysis, one pool worker at a time."""
+        from services.loudness import backfill_one, pending_files
+
+        pending = await asyncio.get_running_loop().run_in_executor(None, pending_files)
+        if pending:
+            log.info("Loudness backfill: %d cached file(s) to analyze", len(pending))
+        done = 0
+        for path in pending:
+            try:
+                done += await self._submit(f"loudness:{path}", None, backfill_one, path, priority=Priority.BACKFILL)
+            except Exception as e:
+                log.error("Loudness analysis of %s failed: %s", path.name, e)
+        if pending:
+            log.info("Loudness backfill finished: %d file(s) analyzed", done)
+
+    async def _submit(
+        self,
+        key: str,
+        guild_id: int | None,
+        fn: Callable[..., Any],
+        *args,
+        priority: Priority = Priority.INTERACTIVE,
+        stale: Callable[[], bool] | None = None,
+    ) -> Any:
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._inflight[key] = future
+            job = _Job(key, fn, args, future, priority, guild_id, stale_checks=[stale] if stale else None)
+            self._enqueue(job)
+            self._dispatch()
+        else:
+            log.info("Joining in-flight job for %s", key)
+            job = self._queued.get(key)
+            if job is not None:
+                self._join(job, priority, stale)
+        # Shield so one caller cancelling doesn't cancel the job for everyone else
+        return await asyncio.shield(future)
+
+    def _join(self, job: _Job, priority: Priority, stale: Callable[[], bool] | None):
+        if stale is None:
+            job.stale_checks = None
+        elif job.stale_checks is not None:
+            job.stale_checks.append(stale)
+        if priority < job.priority:
+            # e.g. a look-ahead download that is now what playback is waiting for
+            log.info("Promoting %s from %s to %s", job.key, job.priority.name, priority.name)
+            self._unqueue(job)
+            job.priority = priority
+            self._enqueue(job)
+
+    def _enqueue(self, job: _Job):
+        self._pending[job.priority].setdefault(job.guild_id, deque()).append(job)
+        self._queued[job.key] = job
+
+    def _unqueue(self, job: _Job):
+        guilds = self._pending[job.priority]
+        jobs = guilds[job.guild_id]
+        jobs.remove(job)
+        if not jobs:
+            del guilds[job.guild_id]
+        del self._queued[job.key]
+
+    def _next_job(self) -> _Job | None:
+        now = time.monotonic()
+        best: tuple[tuple[float, float], Priority] | None = None
+        for priority, guilds in self._pending.items():
+            if not guilds:
+                continue
+            # Waiting counts from when the class was last served, not from when its oldest job
+            # was queued, so a bulk backlog regains its boost only after each job it gets
+            oldest = min(jobs[0].enqueued_at for jobs in guilds.values())
+            waited = now - max(oldest, self._served_at.get(priority, oldest))
+            score = float(priority)
+            if DOWNLOAD_PRIORITY_AGING > 0 and priority > _AGING_CEILING:
+                score = max(float(_AGING_CEILING), score - waited / DOWNLOAD_PRIORITY_AGING)
+            # Ties (an aged class caught up with look-ahead) go to whichever waited longer
+            key = (score, -waited)
+            if best is None or key < best[0]:
+                best = (key, priority)
+        if best is None:
+            return None
+
+        priority = best[1]
+        self._served_at[priority] = now
+        guilds = self._pending[priority]
+        guild_id, jobs = next(iter(guilds.items()))
+        job = jobs.popleft()
+        if jobs:
+            guilds.move_to_end(guild_id)
+        else:
+            del guilds[guild_id]
+        del self._queued[job.key]
+        return job
+
+    def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while self._running < self._max_workers:
+            job = self._next_job()
+            if job is None:
+                return
+            if job.is_stale():
+                log.info("Dropping stale %s job for %s", job.priority.name, job.key)
+                self._inflight.pop(job.key, None)
+                job.future.cancel()
+                continue
+            self._running += 1
+            work = loop.run_in_executor(self._executor, _run_for_guild, job.guild_id, job.fn, *job.args)
+            work.add_done_callback(lambda f, job=job: self._finish(job, f))
+
+    def _finish(self, job: _Job, work: asyncio.Future):
+        self._running -= 1
+        self._inflight.pop(job.key, None)
+        if not job.future.done():
+            if work.cancelled():
+                job.future.cancel()
+            elif work.exception() is not None:
+                job.future.set_exception(work.exception())
+            else:
+                job.future.set_result(work.result())
+        self._dispatch()
+
+
+def _run_for_guild(guild_id: int | None, fn: Callable[..., Any], *args) -> Any:
+    # FFmpeg processes the job starts are counted against the guild that asked for it
+    with guild_scope(guild_id):
+        return fn(*args)
+
+
+_service: DownloadService | None = None
+
+
+def get_download_service() -> DownloadService:
+    global _service
+    if _service is None:
+        _service = DownloadService()
+    return _service
+
+
+DOWNLOAD_QUEUE_DEPTH.set_function(
+    lambda: {(p.name.lower(),): n for p, n in _service.queue_depths().items()} if _service else {}
+)
+DOWNLOAD_RUNNING.set_function(lambda: _service.running if _service else 0)
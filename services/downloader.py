@@ -1,18 +1,87 @@
 from __future__ import annotations
 
 import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
 from dataclasses import dataclass, asdict
 from pathlib import Path
+from typing import TYPE_CHECKING, Iterator
 
-import yt_dlp
+from config import BULK_IMPORT_MAX, DOWNLOAD_LOCK_TIMEOUT, LOUDNESS_NORMALIZE, MP3S_DIR, VIDEOS_DIR
+from services.audio_cache import get_audio_cache
+from services.file_lock import FileLock
+from services.loudness import normalize_file
+from services.metrics import CACHE_LOOKUPS, CONVERT_SECONDS, DOWNLOAD_SECONDS, EXTRACT_SECONDS
+from services.track_index import get_track_index
+from services.transcode import extract_audio
+from utils.helpers import extract_video_id, is_youtube_url, normalize_query, normalize_url, sanitize_filename
 
-from config import MP3S_DIR, VIDEOS_DIR
-from utils.helpers import is_youtube_url, sanitize_filename
+if TYPE_CHECKING:
+    import yt_dlp
 
 log = logging.getLogger(__name__)
 
+# Each download lands in its own scratch directory and is only moved into the cache once
+# complete, so other threads and processes never see or overwrite a half-written file
+_PARTIAL_ROOT = MP3S_DIR / ".partial"
+_LOCK_DIR = MP3S_DIR / ".locks"
+# Scratch directories older than this were left behind by a crashed process
+_STALE_PARTIAL_AGE = 6 * 3600
 
-@dataclass
+# No yt-dlp postprocessors: conversion to Opus goes through the transcode pool instead, so
+# the number of FFmpeg processes stays capped however many downloads run at once
+_YDL_OPTS = {
+    "format": "bestaudio/best",
+    "noplaylist": True,
+    "quiet": True,
+    "no_warnings": True,
+}
+
+# Playlist listing: flat entries only, pulled page by page as they are consumed
+_PLAYLIST_YDL_OPTS = {
+    "extract_flat": "in_playlist",
+    "lazy_playlist": True,
+    "noplaylist": False,
+    "quiet": True,
+    "no_warnings": True,
+}
+
+# YoutubeDL is not thread-safe, so each worker thread keeps its own long-lived instance
+_thread_local = threading.local()
+_partials_cleaned = False
+_partials_lock = threading.Lock()
+
+
+def _get_ydl() -> yt_dlp.YoutubeDL:
+    ydl = getattr(_thread_local, "ydl", None)
+    if ydl is None:
+        # Imported on first use: yt-dlp is the slowest import in the bot
+        import yt_dlp
+        ydl = yt_dlp.YoutubeDL(_YDL_OPTS)
+        _thread_local.ydl = ydl
+    return ydl
+
+
+def _download_ydl(directory: Path) -> yt_dlp.YoutubeDL:
+    """A YoutubeDL that writes into ``directory``. The output template is fixed per instance,
+    so each download gets its own rather than reconfiguring the thread's shared one."""
+    import yt_dlp
+    return yt_dlp.YoutubeDL({**_YDL_OPTS, "outtmpl": str(directory / "%(id)s.%(ext)s")})
+
+
+def _get_playlist_ydl() -> yt_dlp.YoutubeDL:
+    ydl = getattr(_thread_local, "playlist_ydl", None)
+    if ydl is None:
+        import yt_dlp
+        ydl = yt_dlp.YoutubeDL(_PLAYLIST_YDL_OPTS)
+        _thread_local.playlist_ydl = ydl
+    return ydl
+
+
+@dataclass(slots=True)
 class Track:
     title: str
     artist: str
@@ -20,9 +89,21 @@ class Track:
     video_id: str
     mp3_path: str
     duration: int = 0
+    # EBU R128 loudness (LUFS) and true peak (dBTP) as downloaded, and the gain baked into mp3_path
+    loudness: float | None = None
+    peak: float | None = None
+    gain: float = 0.0
+    # Remote audio URL for stream-while-downloading playback; short-lived, never persisted
+    stream_url: str = ""
+
+    @property
+    def has_audio(self) -> bool:
+        return bool(self.mp3_path) and Path(self.mp3_path).exists()
 
     def to_dict(self) -> dict:
-        return asdict(self)
+        data = asdict(self)
+        data.pop("stream_url")
+        return data
 
     @classmethod
     def from_dict(cls, data: dict) -> Track:
@@ -37,11 +118,18 @@ def _build_audio_filename(artist: str, album: str | None, title: str) -> str:
     return sanitize_filename(name) + ".opus"
 
 
+def _info_filename(info: dict, track: Track) -> str:
+    return _build_audio_filename(track.artist, info.get("album") or None, track.title)
+
+
 def _find_cached_audio(video_id: str, pretty_name: str) -> Path | None:
+    sharded_path = get_audio_cache().path_for(video_id, pretty_name)
+    if sharded_path.exists():
+        return sharded_path
+    # Check files from before the cache was sharded, and legacy formats
     pretty_path = MP3S_DIR / pretty_name
     if pretty_path.exists():
         return pretty_path
-    # Check legacy formats
     for ext in (".opus", ".mp3"):
         legacy_path = MP3S_DIR / f"{video_id}{ext}"
         if legacy_path.exists():
@@ -49,70 +137,210 @@ def _find_cached_audio(video_id: str, pretty_name: str) -> Path | None:
     return None
 
 
-def download_and_convert(query: str) -> Track:
+def _lookup_indexed(url: str | None = None, video_id: str | None = None) -> Track | None:
+    """Answer a URL or video_id from the local track index if its audio is still on disk."""
+    index = get_track_index()
+    if url:
+        video_id = extract_video_id(url)
+    data = index.lookup(video_id) if video_id else index.lookup_url(normalize_url(url))
+    if not data:
+        return None
+    if not Path(data["mp3_path"]).exists():
+        log.info("Indexed audio for %s is gone, re-resolving", data["video_id"])
+        return None
+    return Track.from_dict(data)
+
+
+def relink_cached_audio(track: Track) -> bool:
+    """Point a Track at its cached audio if the index knows where it lives now. No network."""
+    if track.has_audio:
+        return True
+    indexed = _lookup_indexed(video_id=track.video_id)
+    if indexed is None:
+        return False
+    track.mp3_path = indexed.mp3_path
+    return True
+
+
+def _remember(track: Track, query: str) -> Track:
+    urls = [normalize_url(track.url)]
+    if is_youtube_url(query):
+        urls.append(normalize_url(query))
+    size = Path(track.mp3_path).stat().st_size if track.has_audio else 0
+    get_track_index().record(track.to_dict(), *urls, size=size)
+    return track
+
+
+def resolve(query: str) -> tuple[Track, dict | None]:
+    """Resolve a query to a Track without downloading.
+
+    Returns the Track plus the extracted info dict when the audio still needs downloading
+    (the Track's ``mp3_path`` is empty and ``stream_url`` points at the remote audio), or
+    ``None`` when the audio is already cached locally.
+    """
+    normalized_query = None
     if is_youtube_url(query):
+        indexed = _lookup_indexed(url=query)
+        if indexed:
+            log.info("Index hit for %s", indexed.video_id)
+            CACHE_LOOKUPS.inc(result="index")
+            return indexed, None
         search_query = query
     else:
-        search_query = f"ytsearch1:{query}"
-
-    ydl_opts = {
-        "format": "bestaudio/best",
-        "outtmpl": str(MP3S_DIR / "%(id)s.%(ext)s"),
-        "noplaylist": True,
-        "quiet": True,
-        "no_warnings": True,
-        "postprocessors": [{
-            "key": "FFmpegExtractAudio",
-            "preferredcodec": "opus",
-            "preferredquality": "128",
-        }],
-    }
-
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(search_query, download=False)
-        if "entries" in info:
-            if not info["entries"]:
-                raise ValueError(f"No results found for: {query}")
-            info = info["entries"][0]
-
-        video_id = info["id"]
-        title = info.get("title", "Unknown")
-        artist = info.get("artist") or info.get("uploader") or "Unknown"
-        album = info.get("album") or None
-        url = info.get("webpage_url", query)
-        duration = info.get("duration", 0)
-
-        pretty_name = _build_audio_filename(artist, album, title)
-        cached = _find_cached_audio(video_id, pretty_name)
+        normalized_query = normalize_query(query)
+        resolved_id = get_track_index().resolve_query(normalized_query)
+        if resolved_id:
+            indexed = _lookup_indexed(video_id=resolved_id)
+            if indexed:
+                log.info("Query cache hit for %r -> %s", query, resolved_id)
+                CACHE_LOOKUPS.inc(result="query")
+                return indexed, None
+            # Known video, audio missing: skip the search and go straight to the video
+            search_query = f"https://www.youtube.com/watch?v={resolved_id}"
+        else:
+            search_query = f"ytsearch1:{query}"
+
+    with EXTRACT_SECONDS.time():
+        info = _get_ydl().extract_info(search_query, download=False)
+    if "entries" in info:
+        if not info["entries"]:
+            raise ValueError(f"No results found for: {query}")
+        info = info["entries"][0]
+
+    video_id = info["id"]
+    if normalized_query:
+        get_track_index().remember_query(normalized_query, video_id)
+    track = Track(
+        title=info.get("title", "Unknown"),
+        artist=info.get("artist") or info.get("uploader") or "Unknown",
+        url=info.get("webpage_url", query),
+        video_id=video_id,
+        mp3_path="",
+        duration=info.get("duration", 0),
+    )
+
+    cached = _find_cached_audio(video_id, _info_filename(info, track))
+    if cached:
+        log.info("Cache hit for %s", video_id)
+        CACHE_LOOKUPS.inc(result="file")
+        track.mp3_path = str(cached)
+        return _remember(track, query), None
+
+    CACHE_LOOKUPS.inc(result="miss")
+    track.stream_url = info.get("url", "")
+    return track, info
+
+
+def _clean_stale_partials():
+    global _partials_cleaned
+    with _partials_lock:
+        if _partials_cleaned:
+            return
+        _partials_cleaned = True
+    cutoff = time.time() - _STALE_PARTIAL_AGE
+    for directory in _PARTIAL_ROOT.glob("*"):
+        try:
+            if directory.stat().st_mtime < cutoff:
+                shutil.rmtree(directory)
+        except OSError:
+            pass
+
+
+def _publish(source: Path, destination: Path):
+    """Flush a finished download to disk and move it into the cache in one atomic step."""
+    with open(source, "r+b") as f:
+        os.fsync(f.fileno())
+    os.replace(source, destination)
+
+
+def download_resolved(track: Track, info: dict) -> Track:
+    """Download and convert audio for a Track previously returned by :func:`resolve`.
+
+    Only one thread or process on the host downloads a given video at a time; the others
+    wait for it and then use its file.
+    """
+    _clean_stale_partials()
+    cache = get_audio_cache()
+    pretty_path = cache.path_for(track.video_id, _info_filename(info, track))
+
+    lock = FileLock(_LOCK_DIR / f"{track.video_id}.lock")
+    if not lock.acquire(DOWNLOAD_LOCK_TIMEOUT):
+        log.warning("Gave up waiting on another download of %s, downloading it too", track.video_id)
+    try:
+        indexed = _lookup_indexed(video_id=track.video_id)
+        cached = indexed.mp3_path if indexed else _find_cached_audio(track.video_id, pretty_path.name)
         if cached:
-            log.info("Cache hit for %s", video_id)
-            return Track(
-                title=title,
-                artist=artist,
-                url=url,
+            log.info("%s was downloaded by another worker meanwhile", track.video_id)
+            track.mp3_path = str(cached)
+            if indexed:
+                track.loudness, track.peak, track.gain = indexed.loudness, indexed.peak, indexed.gain
+                return track
+            return _remember(track, track.url)
+
+        log.info("Downloading %s", track.video_id)
+        _PARTIAL_ROOT.mkdir(parents=True, exist_ok=True)
+        # Unique even when a lock timeout lets two threads of this process download the same video
+        scratch = Path(tempfile.mkdtemp(prefix=f"{os.getpid()}-", dir=_PARTIAL_ROOT))
+        try:
+            # Reuse the info we already extracted instead of letting download() re-extract the page
+            with DOWNLOAD_SECONDS.time():
+                info = _download_ydl(scratch).process_ie_result(info, download=True)
+            downloads = info.get("requested_downloads") or [{}]
+            raw_path = Path(downloads[0].get("filepath") or scratch / f"{track.video_id}.{info.get('ext')}")
+            if not raw_path.exists():
+                raise RuntimeError(f"yt-dlp produced no audio file for {track.video_id}")
+            with CONVERT_SECONDS.time():
+                raw_path = extract_audio(raw_path)
+                # Normalize before publishing so nobody ever plays the unlevelled file
+                loudness = normalize_file(raw_path) if LOUDNESS_NORMALIZE else None
+            if loudness:
+                track.loudness, track.peak, track.gain = loudness.integrated, loudness.peak, loudness.gain
+            _publish(raw_path, pretty_path)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+        track.mp3_path = str(pretty_path)
+        if loudness:
+            get_track_index().record_loudness(track.mp3_path, loudness.integrated, loudness.peak, loudness.gain)
+        _remember(track, track.url)
+    finally:
+        lock.release()
+
+    cache.note_added(pretty_path)
+    return track
+
+
+def iter_playlist(url: str, limit: int = BULK_IMPORT_MAX) -> Iterator[Track]:
+    """Yield a Track per playlist/mix entry as soon as its listing page arrives. No downloads."""
+    ydl = _get_playlist_ydl()
+    info = ydl.extract_info(url, download=False, process=False)
+    # Mix URLs come back as a redirect to the playlist tab
+    while info.get("_type") in ("url", "url_transparent"):
+        info = ydl.extract_info(info["url"], download=False, process=False, ie_key=info.get("ie_key"))
+
+    count = 0
+    for entry in info.get("entries") or ():
+        if count >= limit:
+            break
+        if not entry or not entry.get("id"):
+            continue
+        video_id = entry["id"]
+        indexed = _lookup_indexed(video_id=video_id)
+        if indexed:
+            yield indexed
+        else:
+            yield Track(
+                title=entry.get("title") or "Unknown",
+                artist=entry.get("artist") or entry.get("channel") or entry.get("uploader") or "Unknown",
+                url=f"https://www.youtube.com/watch?v={video_id}",
                 video_id=video_id,
-                mp3_path=str(cached),
-                duration=duration,
+                mp3_path="",
+                duration=int(entry.get("duration") or 0),
             )
+        count += 1
 
-        log.info("Downloading %s", video_id)
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl_dl:
-            ydl_dl.download([url])
 
-        # Rename from video_id.opus to pretty name
-        raw_path = MP3S_DIR / f"{video_id}.opus"
-        pretty_path = MP3S_DIR / pretty_name
-        if raw_path.exists():
-            raw_path.rename(pretty_path)
-            mp3_path = pretty_path
-        else:
-            mp3_path = raw_path
-
-        return Track(
-            title=title,
-            artist=artist,
-            url=url,
-            video_id=video_id,
-            mp3_path=str(mp3_path),
-            duration=duration,
-        )
+def download_and_convert(query: str) -> Track:
+    track, info = resolve(query)
+    if info is None:
+        return track
+    return download_resolved(track, info)
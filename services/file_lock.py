@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+_POLL_INTERVAL = 0.2
+
+if sys.platform == "win32":
+    import msvcrt
+
+    def _try_lock(fd: int) -> bool:
+        os.lseek(fd, 0, os.SEEK_SET)
+        try:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+
+    def _unlock(fd: int):
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+else:
+    import fcntl
+
+    def _try_lock(fd: int) -> bool:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def _unlock(fd: int):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+class FileLock:
+    """Exclusive lock on a file, held across threads and processes on one host.
+
+    The OS drops the lock when its holder exits, so a crashed process never leaves a
+    stale lock behind. Lock files are removed on release where the platform allows it.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._fd: int | None = None
+
+    def acquire(self, timeout: float | None = None) -> bool:
+        """Block until the lock is held, or ``timeout`` seconds pass. Returns whether it is held."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            if _try_lock(fd):
+                if self._still_current(fd):
+                    self._fd = fd
+                    return True
+                # The holder we waited on removed the file; lock the one that replaced it
+                _unlock(fd)
+                os.close(fd)
+                continue
+            os.close(fd)
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(_POLL_INTERVAL)
+
+    def _still_current(self, fd: int) -> bool:
+        if sys.platform == "win32":
+            return True  # open files can't be deleted there, so it can't have been replaced
+        try:
+            return os.fstat(fd).st_ino == os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return False
+
+    def release(self):
+        if self._fd is None:
+            return
+        fd, self._fd = self._fd, None
+        if sys.platform != "win32":
+            # Unlink while still holding it, so waiters notice and re-create it
+            try:
+                self.path.unlink()
+            except OSError:
+                pass
+        _unlock(fd)
+        os.close(fd)
+        if sys.platform == "win32":
+            try:
+                self.path.unlink()
+            except OSError:
+                pass  # another process has it open and will take the lock next
+
+    def __enter__(self) -> FileLock:
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
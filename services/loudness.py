@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import logging
+import os
+import re
+import subprocess
+from dataclasses import dataclass
+from pathlib import Path
+
+from config import LOUDNESS_TARGET_LUFS, LOUDNESS_TOLERANCE_DB
+from services.transcode import get_transcode_pool
+
+log = logging.getLogger(__name__)
+
+_INTEGRATED_RE = re.compile(r"^\s*I:\s+(-?[\d.]+|-inf) LUFS", re.MULTILINE)
+_PEAK_RE = re.compile(r"^\s*Peak:\s+(-?[\d.]+|-inf) dBFS", re.MULTILINE)
+
+# Keep true peaks at least this far below full scale after applying gain
+_PEAK_HEADROOM_DB = 1.0
+
+
+@dataclass(slots=True)
+class Loudness:
+    integrated: float | None  # LUFS, as downloaded; None for silent or unreadable audio
+    peak: float | None  # dBTP, as downloaded
+    gain: float  # dB baked into the cached file
+
+
+def measure(path: str | Path) -> tuple[float, float] | None:
+    """Integrated loudness (LUFS) and true peak (dBTP) via FFmpeg's EBU R128 filter."""
+    result = get_transcode_pool().run(
+        ["ffmpeg", "-hide_banner", "-nostats", "-nostdin", "-i", str(path),
+         "-af", "ebur128=peak=true", "-f", "null", "-"],
+        kind="loudness",
+    )
+    integrated = _INTEGRATED_RE.findall(result.stderr)
+    peak = _PEAK_RE.findall(result.stderr)
+    if result.returncode != 0 or not integrated or not peak or "-inf" in (integrated[-1], peak[-1]):
+        return None
+    # The summary comes last, after the per-frame log lines
+    return float(integrated[-1]), float(peak[-1])
+
+
+def target_gain(integrated: float, peak: float) -> float:
+    gain = LOUDNESS_TARGET_LUFS - integrated
+    return round(min(gain, -_PEAK_HEADROOM_DB - peak), 1)
+
+
+def _apply_gain(path: Path, gain: float):
+    tmp = path.with_name(f".{path.stem}.{os.getpid()}.normalizing.opus")
+    try:
+        get_transcode_pool().run(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin", "-y", "-i", str(path),
+             "-af", f"volume={gain}dB", "-c:a", "libopus", "-b:a", "128k", "-frame_duration", "20",
+             "-ar", "48000", str(tmp)],
+            kind="loudness", check=True,
+        )
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def normalize_file(path: str | Path) -> Loudness | None:
+    """Measure a cached file and, if it is off target by more than the tolerance, re-encode it
+    once with the correcting gain so playback can stay a zero-cost Opus passthrough.
+
+    Returns None if FFmpeg could not run (worth retrying later), and a Loudness with no
+    level for audio it ran on but could not measure.
+    """
+    path = Path(path)
+    try:
+        measured = measure(path)
+    except (OSError, subprocess.SubprocessError) as e:
+        log.warning("Loudness analysis of %s failed: %s", path.name, e)
+        return None
+    if measured is None:
+        log.info("No measurable loudness in %s", path.name)
+        return Loudness(None, None, 0.0)
+
+    integrated, peak = measured
+    gain = target_gain(integrated, peak)
+    if abs(gain) <= LOUDNESS_TOLERANCE_DB or path.suffix != ".opus":
+        return Loudness(integrated, peak, 0.0)
+    try:
+        _apply_gain(path, gain)
+    except (OSError, subprocess.SubprocessError) as e:
+        log.warning("Could not apply %+.1f dB to %s: %s", gain, path.name, e)
+        return Loudness(integrated, peak, 0.0)
+    log.info("Normalized %s: %.1f LUFS, %+.1f dB", path.name, integrated, gain)
+    return Loudness(integrated, peak, gain)
+
+
+def _same_path(path: str | Path) -> str:
+    return os.path.normcase(os.path.abspath(path))
+
+
+def pending_files() -> list[Path]:
+    """Cached audio files, indexed or not, that have no loudness analysis on record."""
+    from services.audio_cache import get_audio_cache
+    from services.track_index import get_track_index
+
+    analyzed = {_same_path(p) for p in get_track_index().analyzed_paths()}
+    return [p for p in get_audio_cache().files() if _same_path(p) not in analyzed]
+
+
+def backfill_one(path: Path) -> bool:
+    """Analyze (and normalize) one cached file that predates loudness analysis."""
+    from services.track_index import get_track_index
+
+    if not path.exists():
+        return False
+    result = normalize_file(path)
+    if result is None:
+        return False
+    get_track_index().record_loudness(str(path), result.integrated, result.peak, result.gain)
+    return result.integrated is not None
+
+
+def backfill() -> int:
+    done = sum(backfill_one(path) for path in pending_files())
+    log.info("Loudness backfill finished: %d file(s) analyzed", done)
+    return done
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    backfill()
@@ -0,0 +1,231 @@
+from __future__ import annotations
+
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+log = logging.getLogger(__name__)
+
+# Seconds; covers a local cache hit (milliseconds) up to a slow download (a minute)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry: list[_Metric] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict[str, object]) -> tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> Iterator[str]:
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge(_Metric):
+    """A value that is set directly, or read from a callback at scrape time.
+
+    A callback returns a number, or for labelled gauges a mapping of label-value tuples
+    to numbers.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+        self._function: Callable[[], float | dict[tuple, float]] | None = None
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function: Callable[[], float | dict[tuple, float]]):
+        self._function = function
+
+    def _samples(self) -> Iterator[str]:
+        if self._function is not None:
+            try:
+                result = self._function()
+            except Exception as e:
+                log.error("Gauge %s callback failed: %s", self.name, e)
+                return
+            values = result.items() if isinstance(result, dict) else [((), result)]
+        else:
+            with self._lock:
+                values = list(self._values.items())
+        for key, value in values:
+            key = tuple(str(v) for v in key)
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # label values -> (per-bucket counts, sum)
+        self._values: dict[tuple[str, ...], tuple[list[int], float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0.0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self) -> Iterator[str]:
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+def render() -> str:
+    """All registered metrics in the Prometheus text exposition format."""
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+async def start_server(host: str, port: int):
+    """Serve ``/metrics`` on a local port. Returns the aiohttp runner so the caller can clean it up."""
+    from aiohttp import web
+
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info("Serving metrics on http://%s:%d/metrics", host, port)
+    return runner
+
+
+# Resolving and downloading
+EXTRACT_SECONDS = Histogram("musicbot_extract_info_seconds", "yt-dlp metadata extraction latency.")
+DOWNLOAD_SECONDS = Histogram("musicbot_download_seconds", "yt-dlp download time per track, excluding conversion.")
+CONVERT_SECONDS = Histogram(
+    "musicbot_convert_seconds", "Opus conversion plus loudness analysis and gain per downloaded track."
+)
+CACHE_LOOKUPS = Counter(
+    "musicbot_cache_lookups_total",
+    "Track resolutions by outcome: index, query or file cache hit, or miss.",
+    ("result",),
+)
+DOWNLOAD_QUEUE_DEPTH = Gauge(
+    "musicbot_download_queue_depth", "Jobs waiting for a download worker, by priority class.", ("priority",)
+)
+DOWNLOAD_RUNNING = Gauge("musicbot_download_running", "Jobs currently running on download workers.")
+
+# FFmpeg
+FFMPEG_PROCESSES = Gauge(
+    "musicbot_ffmpeg_processes", "Live FFmpeg processes by kind (playback, extract, loudness) and guild.",
+    ("kind", "guild"),
+)
+FFMPEG_WAIT_SECONDS = Histogram(
+    "musicbot_ffmpeg_slot_wait_seconds", "Time batch FFmpeg jobs waited for a transcode slot.", ("kind",)
+)
+FFMPEG_TIMEOUTS = Counter("musicbot_ffmpeg_timeouts_total", "FFmpeg processes killed for running too long.", ("kind",))
+
+# Recommendations
+RECOMMEND_SECONDS = Histogram("musicbot_recommend_seconds", "Claude recommendation request latency.")
+RECOMMEND_FAILURES = Counter(
+    "musicbot_recommend_failures_total", "Failed recommendation requests by reason.", ("reason",)
+)
+
+# Playback
+TIME_TO_FIRST_AUDIO = Histogram(
+    "musicbot_time_to_first_audio_seconds",
+    "Time from /play to the first audio packet being sent, by whether it came from the cache, "
+    "a remote stream or an already pre-warmed source.",
+    ("source",),
+)
+TRANSITION_GAP = Histogram(
+    "musicbot_transition_gap_seconds",
+    "Silence between one track ending and the next starting, by whether its source was pre-warmed.",
+    ("prewarmed",),
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+VOICE_CONNECTIONS = Gauge("musicbot_voice_connections", "Connected voice clients.")
+QUEUE_SIZE = Gauge("musicbot_queue_size", "Tracks queued after the current one, per guild.", ("guild",))
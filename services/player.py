@@ -2,21 +2,35 @@ from __future__ import annotations
 
 import asyncio
 import logging
-from typing import TYPE_CHECKING
+import threading
+import time
+from typing import TYPE_CHECKING, Callable
 
 import discord
 
+from config import PREFETCH_LOOKAHEAD, QUEUE_HISTORY, STREAM_WHILE_DOWNLOADING
+from services.audio import FirstReadAudio, PrimedAudio, open_audio_source
+from services.audio_cache import get_audio_cache, register_pin_source
+from services.download_service import Priority
 from services.downloader import Track
+from services.metrics import QUEUE_SIZE, TIME_TO_FIRST_AUDIO, TRANSITION_GAP, VOICE_CONNECTIONS
+from services.track_queue import TrackQueue
+from services.transcode import TrackedFFmpegOpusAudio
 
 if TYPE_CHECKING:
     pass
 
 log = logging.getLogger(__name__)
 
+_STREAM_BEFORE_OPTIONS = "-nostdin -reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+# Unplayable tracks announced one by one before the rest of a run is summed up
+_SKIP_MESSAGES = 3
+
 
 class Player:
-    def __init__(self):
-        self.queue: list[Track] = []
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        self.queue = TrackQueue(QUEUE_HISTORY)
         self.current_index: int = -1
         self.voice_client: discord.VoiceClient | None = None
         self.text_channel: discord.abc.Messageable | None = None
@@ -28,12 +42,20 @@ class Player:
         self.chillax_guild_id: int | None = None
         self._chillax_loading: bool = False
         self._prefetch_task: asyncio.Task | None = None
+        self._lookahead_task: asyncio.Task | None = None
+        # (queue index, track, opened source) for the next track, ready for _after_playback
+        self._prewarmed: tuple[int, Track, discord.AudioSource] | None = None
+        # Claimed from both the voice thread (_after_playback) and the event loop
+        self._prewarmed_lock = threading.Lock()
+        self._prewarm_task: asyncio.Task | None = None
         self._generation: int = 0
         self.silent: bool = False
+        # Monotonic time of the last command or audible playback, for idle reaping
+        self.last_active: float = time.monotonic()
 
     @property
     def current_track(self) -> Track | None:
-        if 0 <= self.current_index < len(self.queue):
+        if self.queue.first_index <= self.current_index < len(self.queue):
             return self.queue[self.current_index]
         return None
 
@@ -41,11 +63,29 @@ class Player:
     def is_playing(self) -> bool:
         return self.voice_client is not None and self.voice_client.is_playing()
 
+    @property
+    def has_listeners(self) -> bool:
+        if not self.voice_client or not self.voice_client.is_connected():
+            return False
+        return any(not member.bot for member in self.voice_client.channel.members)
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
     def add_track(self, track: Track) -> int:
-        self.queue.append(track)
-        return len(self.queue) - 1
+        position = self.queue.append(track)
+        self._schedule_lookahead()
+        if position == self.current_index + 1:
+            self._schedule_prewarm()
+        return position
+
+    def add_tracks(self, tracks: list[Track]):
+        self.queue.extend(tracks)
+        self._schedule_lookahead()
+        self._schedule_prewarm()
 
     def clear_queue(self):
+        self._discard_prewarmed()
         self.queue.clear()
         self.current_index = -1
 
@@ -59,41 +99,256 @@ class Player:
         return self.voice_client
 
     async def disconnect(self):
-        if self.voice_client and self.voice_client.is_connected():
-            await self.voice_client.disconnect()
-        self.voice_client = None
-
-    async def play_track(self, index: int | None = None, announce: bool = True):
+        voice_client, self.voice_client = self.voice_client, None
+        if voice_client and voice_client.is_connected():
+            await voice_client.disconnect()
+
+    async def play_track(
+        self,
+        index: int | None = None,
+        announce: bool = True,
+        ended_at: float | None = None,
+        requested_at: float | None = None,
+    ):
+        """Start the track at ``index`` (default: the cursor).
+
+        ``ended_at`` is when the previous track finished, for automatic advances; it is used
+        to measure the gap between tracks. ``requested_at`` is when a command asked for the
+        track; the time from then until its first packet is sent is recorded.
+        """
         if index is not None:
             self.current_index = index
         elif self.current_index == -1:
-            self.current_index = 0
+            self.current_index = self.queue.first_index
 
         track = self.current_track
         if not track or not self.voice_client:
             return
 
+        source = self._take_prewarmed(self.current_index)
+        prewarmed = source is not None
+        # Tracks that could not be opened; playback moves on to the next one in a loop, so a
+        # run of removed or blocked videos costs neither stack depth nor a message each
+        skipped = 0
+        while source is None:
+            # Opening can wait on a whole download; a stop, skip or disconnect meanwhile wins
+            generation, position = self._generation, self.current_index
+            try:
+                source = await self._open_source(track)
+            except Exception as e:
+                log.error("Could not open %s: %s", track.title, e)
+                if self._superseded(generation, position):
+                    return
+                skipped += 1
+                if skipped <= _SKIP_MESSAGES and self.text_channel and not self.silent:
+                    await self.text_channel.send(f"Skipping **{track.title}**: {e}")
+                    if self._superseded(generation, position):
+                        return
+                if self.current_index + 1 >= len(self.queue):
+                    await self._report_skipped(skipped)
+                    return
+                self.current_index += 1
+                track = self.current_track
+                source = self._take_prewarmed(self.current_index)
+                prewarmed = source is not None
+                continue
+            if self._superseded(generation, position):
+                log.info("Not starting %s: playback moved on while it was opening", track.title)
+                source.cleanup()
+                return
+
         if self.voice_client.is_playing():
             self._generation += 1
             self.voice_client.stop()
 
-        source = discord.FFmpegOpusAudio(str(track.mp3_path), before_options="-nostdin")
+        if requested_at is not None:
+            # Nothing has awaited since the source was opened, so has_audio still says which it was
+            origin = "prewarmed" if prewarmed else "cache" if track.has_audio else "stream"
+            source = FirstReadAudio(
+                source, lambda: TIME_TO_FIRST_AUDIO.observe(time.perf_counter() - requested_at, source=origin)
+            )
+
         self._loop = asyncio.get_running_loop()
+        self._start_playback(source, track)
+        if ended_at is not None:
+            TRANSITION_GAP.observe(time.perf_counter() - ended_at, prewarmed=str(prewarmed).lower())
+        self._on_track_started(track, announce)
+        await self._report_skipped(skipped)
+
+    async def _report_skipped(self, skipped: int):
+        """Sum up a run of unplayable tracks past the ones announced individually."""
+        if skipped > _SKIP_MESSAGES and self.text_channel and not self.silent:
+            await self.text_channel.send(
+                f"Skipped {skipped - _SKIP_MESSAGES} more track(s) that could not be played."
+            )
+
+    def _superseded(self, generation: int, position: int) -> bool:
+        return (
+            self._generation != generation
+            or self.current_index != position
+            or not self.voice_client
+            or not self.voice_client.is_connected()
+        )
+
+    def _start_playback(self, source: discord.AudioSource, track: Track):
         gen = self._generation
         self.voice_client.play(source, after=lambda e: self._after_playback(e, gen))
         log.info("Now playing: %s", track.title)
 
+    def _on_track_started(self, track: Track, announce: bool):
+        """Event-loop side of starting a track: bookkeeping, announcements and background work."""
+        self.queue.trim(self.current_index)
+        if track.has_audio:
+            # A database write another process may hold locked; keep it off the event loop
+            asyncio.get_running_loop().run_in_executor(None, get_audio_cache().touch, track.video_id)
+
         if announce:
             if self.text_channel and not self.silent:
-                asyncio.run_coroutine_threadsafe(
-                    self.text_channel.send(f"Now playing: **[{track.title}]({track.url})** by {track.artist}"),
-                    self._loop,
+                asyncio.create_task(
+                    self.text_channel.send(f"Now playing: **[{track.title}]({track.url})** by {track.artist}")
                 )
             elif self.silent:
                 log.info("[silent] Now playing: %s by %s (%s)", track.title, track.artist, track.url)
 
+        self._schedule_lookahead()
+        self._schedule_prewarm()
+
         if self.chillax_active:
-            asyncio.run_coroutine_threadsafe(self._chillax_prefetch(), self._loop)
+            if self._prefetch_task and not self._prefetch_task.done():
+                self._prefetch_task.cancel()
+            self._prefetch_task = asyncio.create_task(self._chillax_prefetch(Priority.LOOKAHEAD))
+
+    async def _open_source(
+        self,
+        track: Track,
+        priority: Priority = Priority.NOW_PLAYING,
+        stale: Callable[[], bool] | None = None,
+    ) -> discord.AudioSource:
+        from services.download_service import get_download_service
+
+        service = get_download_service()
+        if not track.has_audio and not (STREAM_WHILE_DOWNLOADING and track.stream_url):
+            await service.ensure_downloaded(track, self.guild_id, priority, stale)
+
+        if track.has_audio:
+            return open_audio_source(track.mp3_path, self.guild_id)
+
+        # Cache copy is still downloading; play straight from the remote stream meanwhile
+        log.info("Streaming %s while it downloads", track.video_id)
+        service.cache_in_background(track, self.guild_id, Priority.LOOKAHEAD)
+        return TrackedFFmpegOpusAudio(
+            track.stream_url, guild_id=self.guild_id, before_options=_STREAM_BEFORE_OPTIONS
+        )
+
+    def _stale_check(self) -> Callable[[], bool]:
+        """A check for background downloads that turns True once playback is interrupted
+        (skip, jump, stop), so queued look-ahead work for the old position is dropped."""
+        generation = self._generation
+        return lambda: self._generation != generation
+
+    def _schedule_lookahead(self):
+        """(Re)start downloading the next PREFETCH_LOOKAHEAD tracks after the play cursor."""
+        if PREFETCH_LOOKAHEAD <= 0:
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._lookahead_task and not self._lookahead_task.done():
+            # Downloads are shielded in the download service, so this only drops the waiter
+            self._lookahead_task.cancel()
+        self._lookahead_task = asyncio.create_task(self._prefetch_ahead())
+
+    async def _prefetch_ahead(self):
+        from services.download_service import get_download_service
+
+        start = max(self.current_index, 0)
+        upcoming = [
+            self.queue[i] for i in range(start, min(start + PREFETCH_LOOKAHEAD + 1, len(self.queue)))
+            if i != self.current_index and not self.queue[i].has_audio
+        ]
+        if not upcoming:
+            return
+        service = get_download_service()
+        stale = self._stale_check()
+        results = await asyncio.gather(
+            *(service.ensure_downloaded(track, self.guild_id, Priority.LOOKAHEAD, stale) for track in upcoming),
+            return_exceptions=True,
+        )
+        for track, result in zip(upcoming, results):
+            if isinstance(result, Exception):
+                log.error("Look-ahead download of %s failed: %s", track.title, result)
+
+    def _schedule_prewarm(self):
+        """Open and prime the source for the track after the play cursor, if not done already."""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._prewarm_task and not self._prewarm_task.done():
+            self._prewarm_task.cancel()
+        self._prewarm_task = asyncio.create_task(self._prewarm_next())
+
+    async def _prewarm_next(self):
+        index = self.current_index + 1
+        if self.current_index < 0 or index >= len(self.queue):
+            return
+        track = self.queue[index]
+        prewarmed = self._prewarmed
+        if prewarmed and prewarmed[0] == index and prewarmed[1] is track:
+            return
+
+        loop = asyncio.get_running_loop()
+        try:
+            source = await self._open_source(track, Priority.LOOKAHEAD, self._stale_check())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("Could not pre-warm %s: %s", track.title, e)
+            return
+
+        # Shielded so a cancel (every skip and stop) leaves the read to finish; the source is
+        # closed once the worker thread is done with it rather than underneath it
+        priming = loop.run_in_executor(None, PrimedAudio, source)
+        try:
+            primed = await asyncio.shield(priming)
+        except asyncio.CancelledError:
+            priming.add_done_callback(lambda _: source.cleanup())
+            raise
+        except Exception as e:
+            log.warning("Could not pre-warm %s: %s", track.title, e)
+            source.cleanup()
+            return
+
+        if index != self.current_index + 1 or index >= len(self.queue) or self.queue[index] is not track:
+            primed.cleanup()
+            return
+        with self._prewarmed_lock:
+            previous, self._prewarmed = self._prewarmed, (index, track, primed)
+        if previous:
+            previous[2].cleanup()
+        log.info("Pre-warmed next track: %s", track.title)
+
+    def _take_prewarmed(self, index: int) -> discord.AudioSource | None:
+        """Claim the pre-warmed source if it is for the track now at ``index``. Thread-safe."""
+        with self._prewarmed_lock:
+            prewarmed, self._prewarmed = self._prewarmed, None
+        if prewarmed is None:
+            return None
+        warmed_index, track, source = prewarmed
+        try:
+            if warmed_index == index and self.queue[index] is track:
+                return source
+        except IndexError:
+            pass
+        source.cleanup()
+        return None
+
+    def _discard_prewarmed(self):
+        with self._prewarmed_lock:
+            prewarmed, self._prewarmed = self._prewarmed, None
+        if prewarmed:
+            prewarmed[2].cleanup()
 
     def start_chillax(self, guild_id: int, prompt: str):
         self.chillax_active = True
@@ -108,6 +363,9 @@ class Player:
         if self._prefetch_task and not self._prefetch_task.done():
             self._prefetch_task.cancel()
         self._prefetch_task = None
+        if self.chillax_guild_id is not None:
+            from services.recommender import get_recommender
+            get_recommender().cancel(self.chillax_guild_id)
 
     def _after_playback(self, error: Exception | None, gen: int):
         if error:
@@ -117,17 +375,30 @@ class Player:
         if gen != self._generation:
             return
 
+        ended_at = time.perf_counter()
         if self.current_index + 1 < len(self.queue):
             self.current_index += 1
+            source = self._take_prewarmed(self.current_index)
+            if source and self.voice_client and self.voice_client.is_connected() and self._loop:
+                # Switch straight from the voice thread; only the bookkeeping goes back to the loop
+                track = self.current_track
+                try:
+                    self._start_playback(source, track)
+                    TRANSITION_GAP.observe(time.perf_counter() - ended_at, prewarmed="true")
+                    self._loop.call_soon_threadsafe(self._on_track_started, track, True)
+                    return
+                except Exception as e:
+                    log.error("Pre-warmed switch failed, reopening %s: %s", track.title, e)
+                    source.cleanup()
             if self._loop:
-                asyncio.run_coroutine_threadsafe(self.play_track(), self._loop)
+                asyncio.run_coroutine_threadsafe(self.play_track(ended_at=ended_at), self._loop)
             return
 
         if self.chillax_active and self._loop and not self._chillax_loading:
             self._chillax_loading = True
-            asyncio.run_coroutine_threadsafe(self._chillax_next(), self._loop)
+            asyncio.run_coroutine_threadsafe(self._chillax_next(ended_at), self._loop)
 
-    async def _chillax_prefetch(self):
+    async def _chillax_prefetch(self, priority: Priority = Priority.LOOKAHEAD):
         """Prefetch the next chillax track in the background while current song plays."""
         if not self.chillax_active:
             return
@@ -137,15 +408,11 @@ class Player:
             return
 
         from services.recommender import get_recommender
-        from services.downloader import download_and_convert
+        from services.download_service import get_download_service
 
         try:
             recommender = get_recommender()
-            loop = asyncio.get_running_loop()
-
-            search_query = await loop.run_in_executor(
-                None, recommender.recommend_next, self.chillax_guild_id, self.chillax_prompt
-            )
+            search_query = await recommender.recommend_next(self.chillax_guild_id, self.chillax_prompt)
 
             if not self.chillax_active:
                 return
@@ -154,7 +421,12 @@ class Player:
                 log.warning("Chillax prefetch: no recommendation found")
                 return
 
-            track = await loop.run_in_executor(None, download_and_convert, search_query)
+            # Dropped before it starts if a /reroll or /stopchillax replaced this prefetch meanwhile
+            task = asyncio.current_task()
+            track = await get_download_service().fetch(
+                search_query, self.guild_id, priority,
+                stale=lambda: not self.chillax_active or self._prefetch_task is not task,
+            )
 
             if not self.chillax_active:
                 return
@@ -186,8 +458,8 @@ class Player:
 
         # Remove the prefetched track (anything after current_index)
         if self.current_index + 1 < len(self.queue):
-            removed = self.queue[self.current_index + 1:]
-            del self.queue[self.current_index + 1:]
+            self._discard_prewarmed()
+            removed = self.queue.truncate(self.current_index + 1)
 
             # Remove from recommender history so it can suggest different songs
             from services.recommender import get_recommender
@@ -198,22 +470,19 @@ class Player:
                 if search_str in history:
                     history.remove(search_str)
 
-        # Fetch a new one
-        await self._chillax_prefetch()
+        # Fetch a new one; tracked so a second reroll or /stopchillax can cancel it
+        self._prefetch_task = asyncio.create_task(self._chillax_prefetch(Priority.INTERACTIVE))
+        await self._prefetch_task
         return True
 
-    async def _chillax_next(self):
+    async def _chillax_next(self, ended_at: float | None = None):
         """Fallback: fetch next track on demand if prefetch didn't complete in time."""
         from services.recommender import get_recommender
-        from services.downloader import download_and_convert
+        from services.download_service import get_download_service
 
         try:
             recommender = get_recommender()
-            loop = asyncio.get_running_loop()
-
-            search_query = await loop.run_in_executor(
-                None, recommender.recommend_next, self.chillax_guild_id, self.chillax_prompt
-            )
+            search_query = await recommender.recommend_next(self.chillax_guild_id, self.chillax_prompt)
 
             if search_query is None:
                 if self.text_channel:
@@ -223,10 +492,11 @@ class Player:
                 self.stop_chillax()
                 return
 
-            track = await loop.run_in_executor(None, download_and_convert, search_query)
+            # Playback has already run dry, so this outranks everything else
+            track = await get_download_service().resolve(search_query, self.guild_id, Priority.NOW_PLAYING)
 
             position = self.add_track(track)
-            await self.play_track(position)
+            await self.play_track(position, ended_at=ended_at)
 
         except Exception as e:
             log.error("Chillax next track failed: %s", e)
@@ -235,19 +505,22 @@ class Player:
             await asyncio.sleep(3)
             self._chillax_loading = False
             if self.chillax_active:
-                await self._chillax_next()
+                await self._chillax_next(ended_at)
         finally:
             self._chillax_loading = False
 
     async def skip(self):
         if self.current_index + 1 < len(self.queue):
+            # Before awaiting, so the current track ending meanwhile doesn't advance the cursor too
+            self._generation += 1
             self.current_index += 1
             await self.play_track(announce=False)
             return True
         return False
 
     async def previous(self):
-        if self.current_index > 0:
+        if self.current_index > self.queue.first_index:
+            self._generation += 1
             self.current_index -= 1
             await self.play_track(announce=False)
             return True
@@ -255,7 +528,8 @@ class Player:
 
     async def restart(self):
         if self.queue:
-            self.current_index = 0
+            self._generation += 1
+            self.current_index = self.queue.first_index
             await self.play_track(announce=False)
             return True
         return False
@@ -268,8 +542,20 @@ class Player:
         if self.voice_client and self.voice_client.is_paused():
             self.voice_client.resume()
 
+    async def shutdown(self):
+        """Stop everything this player owns: playback, background tasks and the voice connection."""
+        self.stop()
+        await self.disconnect()
+        self.text_channel = None
+
     def stop(self):
         self.stop_chillax()
+        if self._lookahead_task and not self._lookahead_task.done():
+            self._lookahead_task.cancel()
+        self._lookahead_task = None
+        if self._prewarm_task and not self._prewarm_task.done():
+            self._prewarm_task.cancel()
+        self._prewarm_task = None
         self._generation += 1
         if self.voice_client and (self.voice_client.is_playing() or self.voice_client.is_paused()):
             self.voice_client.stop()
@@ -282,5 +568,73 @@ _players: dict[int, Player] = {}
 
 def get_player(guild_id: int) -> Player:
     if guild_id not in _players:
-        _players[guild_id] = Player()
-    return _players[guild_id]
+        _players[guild_id] = Player(guild_id)
+    player = _players[guild_id]
+    player.touch()
+    return player
+
+
+async def release_player(guild_id: int, reason: str | None = None):
+    """Shut down and forget a guild's player, along with its chillax history."""
+    player = _players.pop(guild_id, None)
+    if player is None:
+        return
+    channel = player.text_channel
+    await player.shutdown()
+    from services.recommender import release_guild
+    release_guild(guild_id)
+    if reason and channel and not player.silent:
+        try:
+            await channel.send(reason)
+        except discord.HTTPException as e:
+            log.warning("Could not announce idle disconnect: %s", e)
+
+
+async def handle_external_disconnect(guild_id: int):
+    """The bot left voice without /leave or /stop (kicked, moved out, connection lost)."""
+    player = _players.get(guild_id)
+    # disconnect() clears voice_client first, so a still-set client means we didn't initiate this
+    if player is not None and player.voice_client is not None:
+        await release_player(guild_id)
+
+
+async def reap_idle_players(timeout: float) -> int:
+    """Release players that have had no audible playback or commands for ``timeout`` seconds."""
+    now = time.monotonic()
+    idle = []
+    for guild_id, player in list(_players.items()):
+        if player.is_playing and player.has_listeners:
+            player.touch()
+        elif now - player.last_active >= timeout:
+            idle.append(guild_id)
+
+    for guild_id in idle:
+        log.info("Releasing idle player for guild %s", guild_id)
+        player = _players.get(guild_id)
+        # Players made by /queue, /skip and the like without ever joining have no voice to leave
+        in_voice = player is not None and player.voice_client is not None
+        reason = f"Left voice after {int(timeout // 60)} minute(s) of inactivity." if in_voice else None
+        await release_player(guild_id, reason)
+    return len(idle)
+
+
+def _queued_audio_paths() -> list[str]:
+    return [track.mp3_path for player in list(_players.values()) for track in list(player.queue)]
+
+
+register_pin_source(_queued_audio_paths)
+
+
+def _voice_connections() -> int:
+    return sum(1 for player in list(_players.values()) if player.voice_client and player.voice_client.is_connected())
+
+
+def _queue_sizes() -> dict[tuple, int]:
+    return {
+        (guild_id,): max(len(player.queue) - max(player.current_index + 1, player.queue.first_index), 0)
+        for guild_id, player in list(_players.items())
+    }
+
+
+VOICE_CONNECTIONS.set_function(_voice_connections)
+QUEUE_SIZE.set_function(_queue_sizes)
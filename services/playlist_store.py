@@ -0,0 +1,254 @@
+from __future__ import annotations
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from config import PLAYLIST_DB_PATH, PLAYLISTS_DIR, PRIMARY_PROCESS, SQLITE_BUSY_TIMEOUT
+from services.downloader import Track
+
+log = logging.getLogger(__name__)
+
+# Namespace holding playlists imported from the pre-guild JSON files; visible to every guild
+# until a guild modifies one, which gives that guild its own copy
+LEGACY_GUILD_ID = 0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS playlists (
+    id          INTEGER PRIMARY KEY,
+    guild_id    INTEGER NOT NULL,
+    name        TEXT NOT NULL,
+    track_count INTEGER NOT NULL DEFAULT 0,
+    created_at  REAL NOT NULL,
+    updated_at  REAL NOT NULL,
+    UNIQUE (guild_id, name)
+);
+CREATE TABLE IF NOT EXISTS playlist_tracks (
+    playlist_id INTEGER NOT NULL REFERENCES playlists(id) ON DELETE CASCADE,
+    position    INTEGER NOT NULL,
+    video_id    TEXT NOT NULL,
+    mp3_path    TEXT NOT NULL,
+    data        TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS playlist_tracks_position ON playlist_tracks(playlist_id, position);
+CREATE INDEX IF NOT EXISTS playlist_tracks_video ON playlist_tracks(video_id);
+-- Legacy playlists a guild has claimed (and may since have renamed), so they no longer
+-- show through under their old name
+CREATE TABLE IF NOT EXISTS hidden_legacy (
+    guild_id INTEGER NOT NULL,
+    name     TEXT NOT NULL,
+    PRIMARY KEY (guild_id, name)
+);
+"""
+
+
+def _encode(track: Track) -> tuple[str, str, str]:
+    data = track.to_dict()
+    mp3_path = data.pop("mp3_path")
+    return track.video_id, mp3_path, json.dumps(data)
+
+
+def _decode(mp3_path: str, data: str) -> Track:
+    return Track.from_dict({**json.loads(data), "mp3_path": mp3_path})
+
+
+class PlaylistStore:
+    """Per-guild playlists in SQLite: every change is its own transaction, counts are kept in
+    the playlists table so listing never touches track rows."""
+
+    def __init__(self, path: Path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.execute("PRAGMA foreign_keys = ON")
+        self._conn.executescript(_SCHEMA)
+
+    def _find(self, guild_id: int, name: str, include_legacy: bool = True) -> int | None:
+        row = self._conn.execute(
+            "SELECT id FROM playlists WHERE guild_id = ? AND name = ?", (guild_id, name)
+        ).fetchone()
+        if row is None and include_legacy:
+            return self._find_legacy(guild_id, name)
+        return row[0] if row else None
+
+    def _find_legacy(self, guild_id: int, name: str) -> int | None:
+        """Id of a legacy playlist the guild can still see."""
+        row = self._conn.execute(
+            "SELECT id FROM playlists WHERE guild_id = ? AND name = ? "
+            "AND name NOT IN (SELECT name FROM hidden_legacy WHERE guild_id = ?)",
+            (LEGACY_GUILD_ID, name, guild_id),
+        ).fetchone()
+        return row[0] if row else None
+
+    def _insert(self, guild_id: int, name: str) -> int:
+        now = time.time()
+        cursor = self._conn.execute(
+            "INSERT INTO playlists (guild_id, name, created_at, updated_at) VALUES (?, ?, ?, ?)",
+            (guild_id, name, now, now),
+        )
+        return cursor.lastrowid
+
+    def _claim(self, guild_id: int, name: str) -> int | None:
+        """Id of the guild's own playlist, copying a legacy playlist into the guild if needed."""
+        playlist_id = self._find(guild_id, name, include_legacy=False)
+        if playlist_id is not None:
+            return playlist_id
+        legacy_id = self._find_legacy(guild_id, name)
+        if legacy_id is None:
+            return None
+        playlist_id = self._insert(guild_id, name)
+        self._conn.execute("INSERT OR IGNORE INTO hidden_legacy (guild_id, name) VALUES (?, ?)", (guild_id, name))
+        self._conn.execute(
+            "INSERT INTO playlist_tracks (playlist_id, position, video_id, mp3_path, data) "
+            "SELECT ?, position, video_id, mp3_path, data FROM playlist_tracks WHERE playlist_id = ?",
+            (playlist_id, legacy_id),
+        )
+        self._conn.execute(
+            "UPDATE playlists SET track_count = (SELECT track_count FROM playlists WHERE id = ?) WHERE id = ?",
+            (legacy_id, playlist_id),
+        )
+        return playlist_id
+
+    def _touch(self, playlist_id: int, delta: int):
+        self._conn.execute(
+            "UPDATE playlists SET track_count = track_count + ?, updated_at = ? WHERE id = ?",
+            (delta, time.time(), playlist_id),
+        )
+
+    def exists(self, guild_id: int, name: str) -> bool:
+        with self._lock:
+            return self._find(guild_id, name) is not None
+
+    def create(self, guild_id: int, name: str) -> bool:
+        with self._lock, self._conn:
+            if self._find(guild_id, name) is not None:
+                return False
+            self._insert(guild_id, name)
+            return True
+
+    def append(self, guild_id: int, name: str, track: Track) -> int | None:
+        """Append a track; returns the new track count, or None if the playlist doesn't exist."""
+        with self._lock, self._conn:
+            playlist_id = self._claim(guild_id, name)
+            if playlist_id is None:
+                return None
+            count = self._conn.execute(
+                "SELECT track_count FROM playlists WHERE id = ?", (playlist_id,)
+            ).fetchone()[0]
+            self._conn.execute(
+                "INSERT INTO playlist_tracks (playlist_id, position, video_id, mp3_path, data) VALUES (?, ?, ?, ?, ?)",
+                (playlist_id, count, *_encode(track)),
+            )
+            self._touch(playlist_id, 1)
+            return count + 1
+
+    def remove(self, guild_id: int, name: str, index: int) -> Track | None:
+        """Remove the track at a 0-based index; returns it, or None if there is no such track."""
+        with self._lock, self._conn:
+            playlist_id = self._claim(guild_id, name)
+            if playlist_id is None:
+                return None
+            row = self._conn.execute(
+                "SELECT mp3_path, data FROM playlist_tracks WHERE playlist_id = ? AND position = ?",
+                (playlist_id, index),
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "DELETE FROM playlist_tracks WHERE playlist_id = ? AND position = ?", (playlist_id, index)
+            )
+            self._conn.execute(
+                "UPDATE playlist_tracks SET position = position - 1 WHERE playlist_id = ? AND position > ?",
+                (playlist_id, index),
+            )
+            self._touch(playlist_id, -1)
+            return _decode(*row)
+
+    def rename(self, guild_id: int, old: str, new: str) -> bool:
+        with self._lock, self._conn:
+            if self._find(guild_id, new) is not None:
+                return False
+            playlist_id = self._claim(guild_id, old)
+            if playlist_id is None:
+                return False
+            self._conn.execute(
+                "UPDATE playlists SET name = ?, updated_at = ? WHERE id = ?", (new, time.time(), playlist_id)
+            )
+            return True
+
+    def tracks(self, guild_id: int, name: str) -> list[Track] | None:
+        with self._lock:
+            playlist_id = self._find(guild_id, name)
+            if playlist_id is None:
+                return None
+            rows = self._conn.execute(
+                "SELECT mp3_path, data FROM playlist_tracks WHERE playlist_id = ? ORDER BY position",
+                (playlist_id,),
+            ).fetchall()
+        return [_decode(*row) for row in rows]
+
+    def list_playlists(self, guild_id: int) -> list[tuple[str, int]]:
+        """(name, track_count) for the guild's playlists plus unclaimed legacy ones."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT name, track_count FROM playlists WHERE guild_id = ? "
+                "UNION ALL "
+                "SELECT name, track_count FROM playlists WHERE guild_id = ? "
+                "AND name NOT IN (SELECT name FROM playlists WHERE guild_id = ?) "
+                "AND name NOT IN (SELECT name FROM hidden_legacy WHERE guild_id = ?) "
+                "ORDER BY name",
+                (guild_id, LEGACY_GUILD_ID, guild_id, guild_id),
+            ).fetchall()
+        return [(name, count) for name, count in rows]
+
+    def update_audio_path(self, video_id: str, mp3_path: str):
+        """Point every saved copy of a video at its current cache file."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE playlist_tracks SET mp3_path = ? WHERE video_id = ?", (mp3_path, video_id)
+            )
+
+    def audio_paths(self) -> list[str]:
+        with self._lock:
+            rows = self._conn.execute("SELECT DISTINCT mp3_path FROM playlist_tracks").fetchall()
+        return [row[0] for row in rows]
+
+    def import_legacy(self, directory: Path):
+        """Import pre-guild ``<name>.json`` playlists into the legacy namespace, once."""
+        for path in sorted(directory.glob("*.json")):
+            try:
+                data = json.loads(path.read_text(encoding="utf-8"))
+                name = data.get("name") or path.stem
+                tracks = [Track.from_dict(t) for t in data.get("tracks", [])]
+            except (OSError, ValueError, TypeError) as e:
+                log.error("Skipping unreadable legacy playlist %s: %s", path, e)
+                continue
+            with self._lock, self._conn:
+                if self._find(LEGACY_GUILD_ID, name, include_legacy=False) is None:
+                    playlist_id = self._insert(LEGACY_GUILD_ID, name)
+                    self._conn.executemany(
+                        "INSERT INTO playlist_tracks (playlist_id, position, video_id, mp3_path, data) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        [(playlist_id, i, *_encode(t)) for i, t in enumerate(tracks)],
+                    )
+                    self._touch(playlist_id, len(tracks))
+            path.replace(path.with_suffix(".json.imported"))
+            log.info("Imported legacy playlist %s (%d tracks)", name, len(tracks))
+
+
+_store: PlaylistStore | None = None
+_store_lock = threading.Lock()
+
+
+def get_playlist_store() -> PlaylistStore:
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = PlaylistStore(PLAYLIST_DB_PATH)
+            if PRIMARY_PROCESS:
+                _store.import_legacy(PLAYLISTS_DIR)
+    return _store
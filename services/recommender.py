@@ -1,60 +1,158 @@
 from __future__ import annotations
 
+import asyncio
 import json
 import logging
-
-import anthropic
-
-from config import ANTHROPIC_API_KEY
+import re
+import time
+from collections import deque
+
+from config import (
+    ANTHROPIC_API_KEY,
+    QUEUE_HISTORY,
+    RECOMMEND_BATCH_SIZE,
+    RECOMMEND_CONCURRENCY,
+    RECOMMEND_LOW_WATER,
+    RECOMMEND_TIMEOUT,
+)
+from services.metrics import RECOMMEND_FAILURES, RECOMMEND_SECONDS
 
 log = logging.getLogger(__name__)
 
+_LIST_PREFIX_RE = re.compile(r"^\s*(?:\d+[.)]|[-*•])\s*")
+
 
 class Recommender:
     def __init__(self):
-        self.client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
-        self._history: dict[int, list[str]] = {}
-
-    def get_history(self, guild_id: int) -> list[str]:
+        # Imported on first use; the SDK takes about a second to import
+        import anthropic
+        self.client = anthropic.AsyncAnthropic(api_key=ANTHROPIC_API_KEY, timeout=RECOMMEND_TIMEOUT)
+        # Per-guild suggestions already handed out, as many as the queue keeps behind the cursor,
+        # so an overnight session neither grows without bound nor re-suggests what just played
+        self._history: dict[int, deque[str]] = {}
+        # Per-guild buffer of suggestions not yet played, and the prompt they were made for
+        self._buffers: dict[int, deque[str]] = {}
+        self._buffer_prompts: dict[int, str] = {}
+        self._refill_tasks: dict[int, asyncio.Task] = {}
+        self._semaphore = asyncio.Semaphore(RECOMMEND_CONCURRENCY)
+
+    def get_history(self, guild_id: int) -> deque[str]:
         if guild_id not in self._history:
-            self._history[guild_id] = []
+            self._history[guild_id] = deque(maxlen=QUEUE_HISTORY)
         return self._history[guild_id]
 
     def clear_history(self, guild_id: int):
         self._history.pop(guild_id, None)
-
-    def recommend_next(self, guild_id: int, prompt: str) -> str | None:
-        history = self.get_history(guild_id)
-
-        history_text = ""
-        if history:
-            recent = history[-15:]
-            history_text = f"\n\nAlready played (do NOT repeat these):\n" + "\n".join(f"- {s}" for s in recent)
-
-        message = self.client.messages.create(
-            model="claude-haiku-4-5-20251001",
-            max_tokens=100,
-            messages=[{
-                "role": "user",
-                "content": (
-                    f"You are a music DJ. Given the vibe/prompt below, suggest exactly ONE song to play next. "
-                    f"Return ONLY the artist and song name in the format: Artist - Song Title\n"
-                    f"No explanation, no quotes, no numbering. Just the artist and song.\n\n"
-                    f"Vibe/prompt: {prompt}"
-                    f"{history_text}"
-                ),
-            }],
-        )
-
-        suggestion = message.content[0].text.strip()
-        if not suggestion or len(suggestion) > 200:
-            log.warning("Bad suggestion from Claude: %s", suggestion)
+        self._buffers.pop(guild_id, None)
+        self._buffer_prompts.pop(guild_id, None)
+        self.cancel(guild_id)
+
+    def cancel(self, guild_id: int):
+        """Abort any background refill for a guild, including its in-flight HTTP request."""
+        task = self._refill_tasks.pop(guild_id, None)
+        if task and not task.done():
+            task.cancel()
+
+    async def recommend_next(self, guild_id: int, prompt: str) -> str | None:
+        """Pop the next suggestion from the guild's buffer, fetching a batch only if it's empty."""
+        if self._buffer_prompts.get(guild_id) != prompt:
+            self.cancel(guild_id)
+            self._buffers[guild_id] = deque()
+            self._buffer_prompts[guild_id] = prompt
+        buffer = self._buffers[guild_id]
+
+        if not buffer:
+            refill = self._refill_tasks.get(guild_id)
+            if refill and not refill.done():
+                # Join the refill already in flight; wait() doesn't cancel it if we are cancelled
+                await asyncio.wait([refill])
+        if not buffer:
+            await self._refill(guild_id, prompt)
+
+        suggestion = buffer.popleft() if buffer else None
+
+        if len(buffer) < RECOMMEND_LOW_WATER:
+            refill = self._refill_tasks.get(guild_id)
+            if refill is None or refill.done():
+                self._refill_tasks[guild_id] = asyncio.create_task(self._background_refill(guild_id, prompt))
+
+        if suggestion is None:
             return None
-
         log.info("Chillax recommending: %s", suggestion)
-        history.append(suggestion)
+        self.get_history(guild_id).append(suggestion)
         return suggestion
 
+    async def _background_refill(self, guild_id: int, prompt: str):
+        try:
+            await self._refill(guild_id, prompt)
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            log.warning("Background recommendation refill timed out after %.0fs", RECOMMEND_TIMEOUT)
+        except Exception as e:
+            log.error("Background recommendation refill failed: %s", e)
+
+    async def _refill(self, guild_id: int, prompt: str):
+        buffered = list(self._buffers.get(guild_id, ()))
+        suggestions = await self._request_batch(prompt, [*self.get_history(guild_id), *buffered])
+
+        # Drop the batch if /chillax was restarted with a new prompt while we waited
+        if self._buffer_prompts.get(guild_id) != prompt:
+            return
+        buffer = self._buffers[guild_id]
+        seen = {s.casefold() for s in self.get_history(guild_id)} | {s.casefold() for s in buffer}
+        for suggestion in suggestions:
+            if suggestion.casefold() not in seen:
+                buffer.append(suggestion)
+                seen.add(suggestion.casefold())
+
+    async def _request_batch(self, prompt: str, exclude: list[str]) -> list[str]:
+        history_text = ""
+        if exclude:
+            recent = exclude[-15:]
+            history_text = f"\n\nAlready played or queued (do NOT repeat these):\n" + "\n".join(f"- {s}" for s in recent)
+
+        async with self._semaphore:
+            start = time.perf_counter()
+            try:
+                # wait_for cancels the request on timeout, which closes the underlying HTTP connection
+                message = await asyncio.wait_for(
+                    self.client.messages.create(
+                        model="claude-haiku-4-5-20251001",
+                        max_tokens=40 * RECOMMEND_BATCH_SIZE,
+                        messages=[{
+                            "role": "user",
+                            "content": (
+                                f"You are a music DJ. Given the vibe/prompt below, suggest exactly {RECOMMEND_BATCH_SIZE} "
+                                f"different songs to play next, in the order they should play. "
+                                f"Return one song per line in the format: Artist - Song Title\n"
+                                f"No explanation, no quotes, no numbering. Just the artist and song.\n\n"
+                                f"Vibe/prompt: {prompt}"
+                                f"{history_text}"
+                            ),
+                        }],
+                    ),
+                    timeout=RECOMMEND_TIMEOUT,
+                )
+            except asyncio.TimeoutError:
+                RECOMMEND_FAILURES.inc(reason="timeout")
+                raise
+            except Exception:
+                RECOMMEND_FAILURES.inc(reason="error")
+                raise
+            RECOMMEND_SECONDS.observe(time.perf_counter() - start)
+
+        suggestions = []
+        for line in message.content[0].text.splitlines():
+            suggestion = _LIST_PREFIX_RE.sub("", line).strip().strip('"')
+            if not suggestion:
+                continue
+            if len(suggestion) > 200:
+                log.warning("Bad suggestion from Claude: %s", suggestion)
+                continue
+            suggestions.append(suggestion)
+        return suggestions
+
 
 _recommender: Recommender | None = None
 
@@ -64,3 +162,9 @@ def get_recommender() -> Recommender:
     if _recommender is None:
         _recommender = Recommender()
     return _recommender
+
+
+def release_guild(guild_id: int):
+    """Drop a guild's history and buffers without creating a client just to do it."""
+    if _recommender is not None:
+        _recommender.clear_history(guild_id)
@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from config import QUERY_CACHE_MAX_ENTRIES, QUERY_CACHE_TTL, SQLITE_BUSY_TIMEOUT, TRACK_INDEX_PATH
+
+log = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    video_id   TEXT PRIMARY KEY,
+    title      TEXT NOT NULL,
+    artist     TEXT NOT NULL,
+    url        TEXT NOT NULL,
+    mp3_path   TEXT NOT NULL,
+    duration   INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL,
+    size        INTEGER NOT NULL DEFAULT 0,
+    last_played REAL NOT NULL DEFAULT 0,
+    play_count  INTEGER NOT NULL DEFAULT 0,
+    loudness    REAL,
+    peak        REAL,
+    gain        REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS urls (
+    url      TEXT PRIMARY KEY,
+    video_id TEXT NOT NULL REFERENCES tracks(video_id) ON DELETE CASCADE
+);
+CREATE TABLE IF NOT EXISTS queries (
+    query       TEXT PRIMARY KEY,
+    video_id    TEXT NOT NULL,
+    resolved_at REAL NOT NULL,
+    last_used   REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS queries_last_used ON queries(last_used);
+CREATE TABLE IF NOT EXISTS loudness_files (
+    path        TEXT PRIMARY KEY,
+    loudness    REAL,  -- NULL: analyzed, but silent or unreadable
+    peak        REAL,
+    gain        REAL NOT NULL DEFAULT 0,
+    analyzed_at REAL NOT NULL
+);
+"""
+
+_TRACK_COLUMNS = ("title", "artist", "url", "video_id", "mp3_path", "duration", "loudness", "peak", "gain")
+
+# Columns added after the first release of tracks.db
+_MIGRATIONS = {
+    "size": "ALTER TABLE tracks ADD COLUMN size INTEGER NOT NULL DEFAULT 0",
+    "last_played": "ALTER TABLE tracks ADD COLUMN last_played REAL NOT NULL DEFAULT 0",
+    "play_count": "ALTER TABLE tracks ADD COLUMN play_count INTEGER NOT NULL DEFAULT 0",
+    "loudness": "ALTER TABLE tracks ADD COLUMN loudness REAL",
+    "peak": "ALTER TABLE tracks ADD COLUMN peak REAL",
+    "gain": "ALTER TABLE tracks ADD COLUMN gain REAL NOT NULL DEFAULT 0",
+}
+
+
+class TrackIndex:
+    """Durable map of video_id / normalized URL -> stored Track fields.
+
+    Shared by the download worker threads, so every statement runs under one lock.
+    """
+
+    def __init__(self, path: Path):
+        self._lock = threading.Lock()
+        # Shared by every bot process in a sharded deployment: WAL lets readers run alongside a writer
+        self._conn = sqlite3.connect(str(path), timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.execute("PRAGMA foreign_keys = ON")
+        self._conn.executescript(_SCHEMA)
+        existing = {row["name"] for row in self._conn.execute("PRAGMA table_info(tracks)")}
+        for column, statement in _MIGRATIONS.items():
+            if column not in existing:
+                self._conn.execute(statement)
+
+    def lookup(self, video_id: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(_TRACK_COLUMNS)} FROM tracks WHERE video_id = ?", (video_id,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def lookup_url(self, url: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute("SELECT video_id FROM urls WHERE url = ?", (url,)).fetchone()
+        return self.lookup(row["video_id"]) if row else None
+
+    def record(self, data: dict, *urls: str, size: int = 0):
+        """Insert or refresh a track and any URLs that resolved to it.
+
+        Play statistics survive a refresh; a new track counts as used now so it isn't
+        the first thing the cache evicts.
+        """
+        values = [data[col] for col in _TRACK_COLUMNS]
+        now = time.time()
+        updates = [
+            f"{col} = excluded.{col}"
+            for col in (*_TRACK_COLUMNS, "updated_at", "size") if col not in ("loudness", "peak", "gain")
+        ]
+        # A Track that was never analyzed in this process must not wipe a stored analysis
+        updates += [
+            "loudness = COALESCE(excluded.loudness, tracks.loudness)",
+            "peak = COALESCE(excluded.peak, tracks.peak)",
+            "gain = CASE WHEN excluded.loudness IS NULL THEN tracks.gain ELSE excluded.gain END",
+        ]
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"INSERT INTO tracks ({', '.join(_TRACK_COLUMNS)}, updated_at, size, last_played) "
+                f"VALUES ({', '.join('?' * len(_TRACK_COLUMNS))}, ?, ?, ?) "
+                f"ON CONFLICT(video_id) DO UPDATE SET {', '.join(updates)}",
+                (*values, now, size, now),
+            )
+            # Files analyzed by the backfill before they were ever indexed
+            self._conn.execute(
+                "UPDATE tracks SET loudness = f.loudness, peak = f.peak, gain = f.gain "
+                "FROM loudness_files AS f WHERE tracks.video_id = ? AND tracks.loudness IS NULL "
+                "AND f.path = tracks.mp3_path AND f.loudness IS NOT NULL",
+                (data["video_id"],),
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO urls (url, video_id) VALUES (?, ?)",
+                [(u, data["video_id"]) for u in urls if u],
+            )
+
+    def resolve_query(self, query: str) -> str | None:
+        """Return the video_id a normalized search query last resolved to, if still fresh."""
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT video_id, resolved_at FROM queries WHERE query = ?", (query,)
+            ).fetchone()
+            if not row:
+                return None
+            if now - row["resolved_at"] > QUERY_CACHE_TTL:
+                self._conn.execute("DELETE FROM queries WHERE query = ?", (query,))
+                return None
+            self._conn.execute("UPDATE queries SET last_used = ? WHERE query = ?", (now, query))
+        return row["video_id"]
+
+    def remember_query(self, query: str, video_id: str):
+        """Cache a query resolution, evicting the least recently used entries past the size cap."""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO queries (query, video_id, resolved_at, last_used) VALUES (?, ?, ?, ?)",
+                (query, video_id, now, now),
+            )
+            self._conn.execute(
+                "DELETE FROM queries WHERE query IN ("
+                "SELECT query FROM queries ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (QUERY_CACHE_MAX_ENTRIES,),
+            )
+
+    def touch(self, video_id: str):
+        """Record a play, for the audio cache's recency-based eviction."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE tracks SET last_played = ?, play_count = play_count + 1 WHERE video_id = ?",
+                (time.time(), video_id),
+            )
+
+    def usage(self) -> dict[str, tuple[float, int]]:
+        """mp3_path -> (last_played, play_count) for every indexed track."""
+        with self._lock:
+            rows = self._conn.execute("SELECT mp3_path, last_played, play_count FROM tracks").fetchall()
+        return {row["mp3_path"]: (row["last_played"], row["play_count"]) for row in rows}
+
+    def analyzed_paths(self) -> set[str]:
+        """Audio paths that have been through loudness analysis, including ones it could not measure."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path FROM loudness_files UNION SELECT mp3_path FROM tracks WHERE loudness IS NOT NULL"
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def record_loudness(self, path: str, loudness: float | None, peak: float | None, gain: float = 0.0):
+        """Store the analysis of a cached file, and copy it onto the track stored there, if any.
+
+        ``loudness`` None marks a silent or unreadable file, so it is not analyzed again.
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO loudness_files (path, loudness, peak, gain, analyzed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (path, loudness, peak, gain, time.time()),
+            )
+            if loudness is not None:
+                self._conn.execute(
+                    "UPDATE tracks SET loudness = ?, peak = ?, gain = ? WHERE mp3_path = ?",
+                    (loudness, peak, gain, path),
+                )
+
+    def forget_path(self, mp3_path: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM tracks WHERE mp3_path = ?", (mp3_path,))
+            self._conn.execute("DELETE FROM loudness_files WHERE path = ?", (mp3_path,))
+
+
+_index: TrackIndex | None = None
+_index_lock = threading.Lock()
+
+
+def get_track_index() -> TrackIndex:
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = TrackIndex(TRACK_INDEX_PATH)
+            log.info("Track index opened at %s", TRACK_INDEX_PATH)
+    return _index
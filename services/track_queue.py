@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+from collections import deque
+from typing import Iterable, Iterator
+
+from services.downloader import Track
+
+
+class TrackQueue:
+    """Play queue addressed by stable absolute indices that keeps only a window of history.
+
+    Index ``i`` keeps meaning the same track for as long as it is retained; tracks more than
+    ``history`` places behind the play cursor are dropped, so ``first_index`` creeps forward
+    in long sessions. ``len()`` is the absolute end index, which keeps ``i < len(queue)``
+    bounds checks valid.
+    """
+
+    __slots__ = ("_items", "_base", "history")
+
+    def __init__(self, history: int):
+        self._items: deque[Track] = deque()
+        self._base = 0
+        self.history = history
+
+    @property
+    def first_index(self) -> int:
+        return self._base
+
+    def __len__(self) -> int:
+        return self._base + len(self._items)
+
+    def __bool__(self) -> bool:
+        return bool(self._items)
+
+    def __iter__(self) -> Iterator[Track]:
+        return iter(self._items)
+
+    def __getitem__(self, index: int) -> Track:
+        if index < self._base:
+            raise IndexError(f"track {index} has left the history window")
+        return self._items[index - self._base]
+
+    def append(self, track: Track) -> int:
+        self._items.append(track)
+        return len(self) - 1
+
+    def extend(self, tracks: Iterable[Track]):
+        self._items.extend(tracks)
+
+    def truncate(self, index: int) -> list[Track]:
+        """Remove and return every track at or after ``index``."""
+        removed = []
+        while len(self) > max(index, self._base):
+            removed.append(self._items.pop())
+        removed.reverse()
+        return removed
+
+    def trim(self, current_index: int):
+        """Drop tracks that fell more than ``history`` places behind the play cursor."""
+        while self._items and self._base < current_index - self.history:
+            self._items.popleft()
+            self._base += 1
+
+    def clear(self):
+        self._items.clear()
+        self._base = 0
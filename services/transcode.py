@@ -0,0 +1,221 @@
+from __future__ import annotations
+
+import logging
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator
+
+import discord
+
+from config import FFMPEG_CPU_AFFINITY, FFMPEG_MAX_PROCESSES, FFMPEG_NICE, FFMPEG_TIMEOUT, MP3S_DIR
+from services.file_lock import FileLock
+from services.metrics import FFMPEG_PROCESSES, FFMPEG_TIMEOUTS, FFMPEG_WAIT_SECONDS
+
+log = logging.getLogger(__name__)
+
+# One lock file per FFmpeg slot, shared by every bot process using this cache directory
+_SLOT_DIR = MP3S_DIR / ".locks"
+_SLOT_POLL_INTERVAL = 0.2
+
+# Containers yt-dlp hands back whose Opus stream can be copied into Ogg without re-encoding
+_OPUS_CONTAINERS = (".webm", ".mka", ".ogg")
+
+# The guild whose download a worker thread is running, for subprocess accounting
+_thread_local = threading.local()
+
+
+@dataclass(slots=True)
+class _Process:
+    process: subprocess.Popen
+    guild_id: int | None
+    kind: str
+    started_at: float
+
+
+@contextmanager
+def guild_scope(guild_id: int | None) -> Iterator[None]:
+    """Attribute FFmpeg processes started by this thread to ``guild_id`` until exit."""
+    previous = getattr(_thread_local, "guild_id", None)
+    _thread_local.guild_id = guild_id
+    try:
+        yield
+    finally:
+        _thread_local.guild_id = previous
+
+
+def _current_guild() -> int | None:
+    return getattr(_thread_local, "guild_id", None)
+
+
+def _deprioritize(pid: int):
+    """Lower a batch process's CPU priority so it yields to voice encoding and the event loop."""
+    try:
+        if FFMPEG_NICE and hasattr(os, "setpriority"):
+            os.setpriority(os.PRIO_PROCESS, pid, FFMPEG_NICE)
+        if FFMPEG_CPU_AFFINITY and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(pid, FFMPEG_CPU_AFFINITY)
+    except OSError as e:
+        # The process may already have exited, or the platform refuses; not worth failing the job
+        log.debug("Could not set priority of FFmpeg process %d: %s", pid, e)
+
+
+class TranscodePool:
+    """Runs batch FFmpeg jobs (download conversion, loudness analysis and gain) with at most
+    ``FFMPEG_MAX_PROCESSES`` at once across the host, at reduced CPU priority and with a hard
+    timeout. The cap is held with lock files, so worker processes started by ``launcher.py``
+    share it.
+
+    Playback processes are not capped, since a listener is waiting on them, but they are
+    tracked alongside batch jobs so live FFmpeg processes can be counted per guild.
+    """
+
+    def __init__(self, max_processes: int = FFMPEG_MAX_PROCESSES):
+        self._max_processes = max(1, max_processes)
+        # Threads of this process queue here rather than all polling the lock files
+        self._slots = threading.BoundedSemaphore(self._max_processes)
+        self._lock = threading.Lock()
+        self._live: dict[int, _Process] = {}
+
+    @contextmanager
+    def _host_slot(self) -> Iterator[None]:
+        while True:
+            for i in range(self._max_processes):
+                lock = FileLock(_SLOT_DIR / f"ffmpeg-{i}.lock")
+                if lock.acquire(timeout=0):
+                    try:
+                        yield
+                    finally:
+                        lock.release()
+                    return
+            time.sleep(_SLOT_POLL_INTERVAL)
+
+    def run(
+        self,
+        args: list[str],
+        kind: str,
+        timeout: float = FFMPEG_TIMEOUT,
+        check: bool = False,
+        guild_id: int | None = None,
+    ) -> subprocess.CompletedProcess:
+        """Run an FFmpeg command line to completion, waiting for a free slot first.
+
+        Output is captured as text. A process still running after ``timeout`` seconds is
+        killed and :class:`subprocess.TimeoutExpired` raised.
+        """
+        guild_id = _current_guild() if guild_id is None else guild_id
+        waited = time.perf_counter()
+        with self._slots, self._host_slot():
+            FFMPEG_WAIT_SECONDS.observe(time.perf_counter() - waited, kind=kind)
+            process = subprocess.Popen(
+                args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                text=True, errors="replace",
+            )
+            _deprioritize(process.pid)
+            self.track(process, guild_id, kind)
+            try:
+                stdout, stderr = process.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                log.warning("Killing %s FFmpeg process %d after %gs", kind, process.pid, timeout)
+                FFMPEG_TIMEOUTS.inc(kind=kind)
+                process.kill()
+                process.communicate()
+                raise
+            finally:
+                self.untrack(process)
+
+        result = subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
+        if check:
+            result.check_returncode()
+        return result
+
+    def track(self, process: subprocess.Popen, guild_id: int | None, kind: str):
+        with self._lock:
+            self._live[process.pid] = _Process(process, guild_id, kind, time.monotonic())
+
+    def untrack(self, process: subprocess.Popen):
+        with self._lock:
+            entry = self._live.get(process.pid)
+            if entry and entry.process is process:
+                del self._live[process.pid]
+
+    def live(self) -> list[_Process]:
+        """Live FFmpeg processes; entries whose process has exited are dropped."""
+        with self._lock:
+            for pid, entry in list(self._live.items()):
+                if entry.process.poll() is not None:
+                    del self._live[pid]
+            return list(self._live.values())
+
+    def counts(self) -> dict[tuple[str, str], int]:
+        """Live process counts keyed by (kind, guild)."""
+        counts: dict[tuple[str, str], int] = {}
+        for entry in self.live():
+            key = (entry.kind, "none" if entry.guild_id is None else str(entry.guild_id))
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+
+class TrackedFFmpegOpusAudio(discord.FFmpegOpusAudio):
+    """``FFmpegOpusAudio`` whose process is counted against its guild while it lives."""
+
+    def __init__(self, source: str, *, guild_id: int | None = None, **kwargs):
+        self._guild_id = guild_id
+        super().__init__(source, **kwargs)
+
+    def _spawn_process(self, args, **subprocess_kwargs) -> subprocess.Popen:
+        process = super()._spawn_process(args, **subprocess_kwargs)
+        get_transcode_pool().track(process, self._guild_id, "playback")
+        return process
+
+    def cleanup(self):
+        process = self._process
+        super().cleanup()
+        if process:
+            get_transcode_pool().untrack(process)
+
+
+def extract_audio(path: Path) -> Path:
+    """Turn a downloaded file into Ogg Opus next to it, copying the Opus stream when the
+    container already holds one, and remove the original. Returns the ``.opus`` path."""
+    if path.suffix == ".opus":
+        return path
+    out = path.with_suffix(".opus")
+    pool = get_transcode_pool()
+    base = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin", "-y", "-i", str(path), "-vn"]
+    try:
+        if path.suffix in _OPUS_CONTAINERS:
+            result = pool.run([*base, "-c:a", "copy", str(out)], kind="extract")
+            if result.returncode == 0:
+                return out
+            log.info("Could not copy the audio of %s (%s), re-encoding", path.name, result.stderr.strip())
+        pool.run(
+            [*base, "-c:a", "libopus", "-b:a", "128k", "-frame_duration", "20", "-ar", "48000", str(out)],
+            kind="extract", check=True,
+        )
+        return out
+    except BaseException:
+        out.unlink(missing_ok=True)
+        raise
+    finally:
+        if out.exists():
+            path.unlink(missing_ok=True)
+
+
+_pool: TranscodePool | None = None
+_pool_lock = threading.Lock()
+
+
+def get_transcode_pool() -> TranscodePool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = TranscodePool()
+    return _pool
+
+
+FFMPEG_PROCESSES.set_function(lambda: _pool.counts() if _pool else {})
@@ -0,0 +1,76 @@
+import asyncio
+import threading
+import unittest
+from unittest import mock
+
+from services import download_service
+from services.download_service import DownloadService, Priority
+
+_AGING = 0.05
+
+
+class SchedulerTest(unittest.IsolatedAsyncioTestCase):
+    """One worker, blocked until the test has queued everything, so dispatch order is observable."""
+
+    async def asyncSetUp(self):
+        patcher = mock.patch.object(download_service, "DOWNLOAD_PRIORITY_AGING", _AGING)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.service = DownloadService(max_workers=1)
+        self.order: list[str] = []
+        self.gate = threading.Event()
+        self.blocker = asyncio.create_task(self.service._submit("blocker", None, self.gate.wait))
+        await asyncio.sleep(0)
+
+    def submit(self, key: str, priority: Priority, guild_id: int | None = 1, stale=None) -> asyncio.Task:
+        return asyncio.create_task(
+            self.service._submit(key, guild_id, self.order.append, key, priority=priority, stale=stale)
+        )
+
+    async def drain(self, tasks: list[asyncio.Task]) -> list:
+        self.gate.set()
+        await self.blocker
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def test_aged_backlog_never_overtakes_interactive_or_now_playing(self):
+        backlog = [self.submit(f"backfill{i}", Priority.BACKFILL) for i in range(32)]
+        await asyncio.sleep(_AGING * 5)
+        interactive = self.submit("interactive", Priority.INTERACTIVE, guild_id=2)
+        now_playing = self.submit("now_playing", Priority.NOW_PLAYING, guild_id=3)
+        await self.drain([*backlog, interactive, now_playing])
+        self.assertEqual(self.order[:2], ["now_playing", "interactive"])
+
+    async def test_aged_backfill_interleaves_with_lookahead(self):
+        backlog = [self.submit(f"backfill{i}", Priority.BACKFILL) for i in range(4)]
+        await asyncio.sleep(_AGING * 5)
+        lookahead = [self.submit(f"lookahead{i}", Priority.LOOKAHEAD, guild_id=2) for i in range(4)]
+        await self.drain([*backlog, *lookahead])
+        # The starved class gets a job, then has to age again rather than draining its backlog
+        self.assertTrue(self.order[0].startswith("backfill"))
+        self.assertTrue(self.order[1].startswith("lookahead"))
+
+    async def test_joining_request_promotes_queued_job(self):
+        backlog = [self.submit(f"backfill{i}", Priority.BACKFILL) for i in range(3)]
+        promoted = self.submit("backfill2", Priority.NOW_PLAYING, guild_id=2)
+        await self.drain([*backlog, promoted])
+        self.assertEqual(self.order[0], "backfill2")
+
+    async def test_stale_job_is_cancelled_before_running(self):
+        generation = [0]
+        stale = self.submit("lookahead", Priority.LOOKAHEAD, stale=lambda: generation[0] != 0)
+        fresh = self.submit("interactive", Priority.INTERACTIVE)
+        await asyncio.sleep(0)
+        generation[0] += 1
+        results = await self.drain([stale, fresh])
+        self.assertIsInstance(results[0], asyncio.CancelledError)
+        self.assertEqual(self.order, ["interactive"])
+
+    async def test_job_with_an_unchecked_requester_is_never_stale(self):
+        stale = self.submit("lookahead", Priority.LOOKAHEAD, stale=lambda: True)
+        joined = self.submit("lookahead", Priority.LOOKAHEAD)
+        await self.drain([stale, joined])
+        self.assertEqual(self.order, ["lookahead"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,8 @@
 import re
-from urllib.parse import urlparse
+from urllib.parse import parse_qs, urlencode, urlparse
+
+_YOUTUBE_ID_RE = re.compile(r"^[A-Za-z0-9_-]{11}$")
+_YOUTUBE_PATH_PREFIXES = ("/shorts/", "/embed/", "/live/", "/v/")
 
 
 def is_youtube_url(query: str) -> bool:
@@ -10,6 +13,57 @@ def is_youtube_url(query: str) -> bool:
     return any(domain in host for domain in ("youtube.com", "youtu.be", "youtube-nocookie.com"))
 
 
+def extract_video_id(url: str) -> str | None:
+    """Pull the 11-character video id out of a YouTube URL without hitting the network."""
+    if not is_youtube_url(url):
+        return None
+    parsed = urlparse(url)
+    host = parsed.hostname or ""
+    candidate = None
+    if host.endswith("youtu.be"):
+        candidate = parsed.path.lstrip("/").split("/")[0]
+    elif parsed.path == "/watch":
+        candidate = parse_qs(parsed.query).get("v", [None])[0]
+    else:
+        for prefix in _YOUTUBE_PATH_PREFIXES:
+            if parsed.path.startswith(prefix):
+                candidate = parsed.path[len(prefix):].split("/")[0]
+                break
+    if candidate and _YOUTUBE_ID_RE.match(candidate):
+        return candidate
+    return None
+
+
+def is_playlist_url(url: str) -> bool:
+    """YouTube playlist pages and auto-generated mixes (``list=RD...``), which import in bulk."""
+    if not is_youtube_url(url):
+        return False
+    parsed = urlparse(url)
+    list_id = parse_qs(parsed.query).get("list", [""])[0]
+    if not list_id:
+        return False
+    return parsed.path.rstrip("/") == "/playlist" or list_id.startswith("RD")
+
+
+def normalize_url(url: str) -> str:
+    """Canonical form of a URL for cache lookups (host case, www/m prefixes, tracking params)."""
+    parsed = urlparse(url.strip())
+    host = (parsed.hostname or "").lower()
+    for prefix in ("www.", "m.", "music."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    params = parse_qs(parsed.query)
+    kept = sorted((k, v[0]) for k, v in params.items() if k in ("v", "list"))
+    query = f"?{urlencode(kept)}" if kept else ""
+    return f"https://{host}{parsed.path.rstrip('/')}{query}"
+
+
+def normalize_query(query: str) -> str:
+    """Fold case, punctuation and whitespace so equivalent searches share a cache key."""
+    query = re.sub(r"[^\w\s]", " ", query.casefold())
+    return " ".join(query.split())
+
+
 def sanitize_filename(name: str) -> str:
     name = re.sub(r'[<>:"/\\|?*]', "_", name)
     name = re.sub(r"\s+", "_", name)